@@ -0,0 +1,174 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from collections import Iterator
+import hashlib
+import inspect
+import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import tempfile
+
+from anflow.utils import get_dependency_files
+
+
+def function_hash(func, root_path):
+    """Generate an md5 hash of the source of the supplied function and the
+    contents of the files under root_path that it depends on"""
+
+    func = getattr(func, 'original', func)
+    md5 = hashlib.md5()
+    try:
+        md5.update(inspect.getsource(func).encode('utf-8'))
+    except (IOError, TypeError):
+        md5.update("{}.{}".format(func.__module__, func.__name__)
+                   .encode('utf-8'))
+    for filename in sorted(get_dependency_files(func, root_path)):
+        with open(filename, 'rb') as f:
+            md5.update(f.read())
+    return md5.hexdigest()
+
+
+def _loader_name(loader):
+    """Describe the supplied loader by the name of its function and any
+    arguments bound to it, which is the same in every process"""
+
+    func = getattr(loader, 'func', loader)
+    return "{}.{}{}{}".format(getattr(func, '__module__', None),
+                              getattr(func, '__name__', type(func).__name__),
+                              repr(getattr(loader, 'args', ())),
+                              repr(sorted(getattr(loader, 'kwargs',
+                                                  {}).items())))
+
+
+def datum_hash(datum):
+    """Generate an md5 hash of the parameters and data of the supplied datum.
+    Data streamed from a loader can only be read once, so it's identified by
+    the filename, timestamp and loader instead"""
+
+    md5 = hashlib.md5()
+    md5.update(repr(sorted(datum.params.items())).encode('utf-8'))
+    data = datum.data
+    if isinstance(data, Iterator):
+        md5.update(repr((datum.filename, datum.timestamp,
+                         _loader_name(getattr(datum, 'loader', None))))
+                   .encode('utf-8'))
+    else:
+        md5.update(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+    return md5.hexdigest()
+
+
+class ResultCache(object):
+    """Persistent cache of model results, stored as one pickle file per result
+    and keyed on hashes of the model code, input data and parameters. If a
+    maximum size in bytes is given, the least recently accessed results are
+    evicted when the cache grows beyond it"""
+
+    def __init__(self, path, max_size=None):
+        """Constructor - creates the cache directory as required"""
+
+        self.path = path
+        self.max_size = max_size
+        self._size = None
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def key(func_hash, input_hash, params):
+        """Generate the cache key for a model run"""
+        md5 = hashlib.md5()
+        md5.update(func_hash.encode('utf-8'))
+        md5.update(input_hash.encode('utf-8'))
+        md5.update(repr(sorted(params.items())).encode('utf-8'))
+        return md5.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key + ".pkl")
+
+    def _entries(self):
+        """Return a list of (access time, size, filename) tuples for all the
+        files in the cache"""
+        entries = []
+        for directory, subdirs, files in os.walk(self.path):
+            for f in files:
+                if not f.endswith(".pkl"):
+                    continue
+                filename = os.path.join(directory, f)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    def lookup(self, key):
+        """Look up the result with the supplied key, raising a KeyError if it
+        isn't in the cache"""
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                result = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            raise KeyError(key)
+        # Mark the entry as recently used
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return result
+
+    def store(self, key, result):
+        """Store the supplied result in the cache, evicting old entries if the
+        cache is too large"""
+        filename = self._filename(key)
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError:
+            pass
+        # Write to a temporary file first so that other processes using the
+        # cache never see partially written results
+        handle, temp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(filename), suffix=".tmp")
+        with os.fdopen(handle, 'wb') as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, filename)
+
+        if self.max_size is not None:
+            if self._size is None:
+                self._size = sum(entry[1] for entry in self._entries())
+            else:
+                self._size += os.path.getsize(filename)
+            if self._size > self.max_size:
+                self.prune()
+
+    def stats(self):
+        """Return a dictionary containing the number of entries in the cache
+        and their total size in bytes"""
+        entries = self._entries()
+        return {'entries': len(entries),
+                'size': sum(entry[1] for entry in entries),
+                'max_size': self.max_size}
+
+    def prune(self, max_size=None):
+        """Remove the least recently accessed entries until the total size of
+        the cache is no greater than max_size, which defaults to the cache's
+        maximum size. Returns the number of entries removed"""
+        max_size = self.max_size if max_size is None else max_size
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        removed = 0
+        for timestamp, entry_size, filename in entries:
+            if max_size is None or size <= max_size:
+                break
+            try:
+                os.unlink(filename)
+            except OSError:
+                continue
+            size -= entry_size
+            removed += 1
+        self._size = size
+        return removed
@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+
+from anflow.cache import ResultCache
+from anflow.management import load_project_config
+
+
+def main(argv):
+    """Main command"""
+
+    config = load_project_config()
+    cache_path = getattr(config, 'RESULT_CACHE_PATH', None)
+    max_size = getattr(config, 'RESULT_CACHE_SIZE', None)
+
+    try:
+        action = argv[0]
+    except IndexError:
+        action = None
+    if action not in ['stats', 'prune']:
+        print("Usage: {} cache stats|prune [max size in bytes]"
+              .format(sys.argv[0]))
+        return
+    if not cache_path:
+        print("No result cache configured, set RESULT_CACHE_PATH in settings")
+        return
+
+    cache = ResultCache(cache_path, max_size)
+    if action == 'stats':
+        stats = cache.stats()
+        print("Result cache: {}".format(cache_path))
+        print("    Entries: {}".format(stats['entries']))
+        print("    Size: {} bytes".format(stats['size']))
+        print("    Maximum size: {}".format(stats['max_size']))
+    else:
+        try:
+            max_size = int(argv[1])
+        except IndexError:
+            pass
+        removed = cache.prune(max_size)
+        print("Removed {} entries from {}".format(removed, cache_path))
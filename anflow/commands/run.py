@@ -1,31 +1,47 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import argparse
 import xml.etree.ElementTree as ET
 from lxml import etree
 import sys
 
 from anflow.management import load_project_config
+from anflow.scheduler import Scheduler
 from anflow.xml import simulation_from_etree
 
 
+def parse_args(argv):
+    """Parses the command line arguments for the run command"""
+
+    parser = argparse.ArgumentParser(prog="{} run".format(sys.argv[0]))
+    parser.add_argument("input_file", help="The input xml file")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="The number of processes to run each model "
+                             "with, if branches aren't run concurrently")
+    parser.add_argument("-b", "--branches", type=int, default=1,
+                        help="The number of independent models and views to "
+                             "run concurrently")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Rerun models even if their results are up to "
+                             "date")
+    return parser.parse_args(argv)
+
+
 def main(argv):
     """Main command"""
 
     config = load_project_config()
 
-    try:
-        input_file = argv[0]
-    except IndexError:
-        print("Usage: {} run <input xml file>".format(sys.argv[0]))
+    args = parse_args(argv)
+    input_file = args.input_file
 
     tree = etree.parse(input_file)
     simname = input_file.replace("/", "_").replace(".", "_")
     simulation, parameters, queries = simulation_from_etree(tree, simname)
     simulation.config.from_object(config)
 
-    for tag in simulation.models.keys():
-        simulation.run_model(tag,parameters[tag], queries[tag])
-
-    for tag in simulation.views.keys():
-        simulation.run_view(tag, parameters[tag], queries[tag])
+    scheduler = Scheduler(simulation, parameters, queries,
+                          workers=args.branches, model_workers=args.jobs,
+                          force=args.force)
+    scheduler.run()
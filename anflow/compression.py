@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import bz2
+from collections import namedtuple
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import struct
+import threading
+import zlib
+
+
+Codec = namedtuple("Codec", ("compress", "decompress"))
+
+codecs = {'zlib': Codec(zlib.compress, zlib.decompress),
+          'bz2': Codec(bz2.compress, bz2.decompress)}
+
+_magic = b'ANFZ'
+_header_length = struct.Struct(b'<Q')
+
+# The compressors release the GIL, so a thread pool is enough to use all the
+# cores of the node. The pool is shared between all the files being written
+# by a process, and is recreated in forked processes, which don't inherit the
+# pool's threads
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_codec(name):
+    """Retrieve the named codec, raising a ValueError if it doesn't exist"""
+    try:
+        return codecs[name]
+    except KeyError:
+        raise ValueError("Unknown compression codec {}, expected one of {}"
+                         .format(name, sorted(codecs.keys())))
+
+
+def _get_pool():
+    """Create the shared compression thread pool if it doesn't exist in this
+    process"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(cpu_count())
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _map(func, items):
+    """Apply func to each of the items, using the thread pool if there's more
+    than one"""
+    if len(items) > 1:
+        return _get_pool().map(func, items)
+    return [func(item) for item in items]
+
+
+def compress(string, codec='zlib', level=6, chunk_size=2**20):
+    """Split the supplied string into chunks of chunk_size bytes and compress
+    them concurrently, returning the list of compressed chunks"""
+    compress_func = get_codec(codec).compress
+    chunks = [string[i:i + chunk_size]
+              for i in range(0, len(string), chunk_size)]
+    return _map(lambda chunk: compress_func(chunk, level), chunks)
+
+
+def write(filename, string, codec='zlib', level=6, chunk_size=2**20):
+    """Compress the supplied string and write it to filename, along with a
+    header that allows the file to be decompressed in parts"""
+    chunks = compress(string, codec, level, chunk_size)
+    header = pickle.dumps({'codec': codec, 'chunk_size': chunk_size,
+                           'length': len(string),
+                           'chunks': [len(chunk) for chunk in chunks]}, 2)
+    with open(filename, 'wb') as f:
+        f.write(_magic)
+        f.write(_header_length.pack(len(header)))
+        f.write(header)
+        for chunk in chunks:
+            f.write(chunk)
+
+
+class CompressedFile(object):
+    """Read access to a file written using write, decompressing only the
+    chunks needed for the requested range of bytes"""
+
+    def __init__(self, filename):
+        """Constructor - reads the header of the file"""
+
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(_magic)) != _magic:
+                raise IOError("{} is not a compressed file".format(filename))
+            size, = _header_length.unpack(f.read(_header_length.size))
+            header = pickle.loads(f.read(size))
+            start = f.tell()
+        self.codec = header['codec']
+        self.chunk_size = header['chunk_size']
+        self.length = header['length']
+        self._offsets = []
+        for length in header['chunks']:
+            self._offsets.append((start, length))
+            start += length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, start=0, stop=None):
+        """Read the uncompressed bytes between start and stop"""
+        stop = self.length if stop is None else min(stop, self.length)
+        if start >= stop:
+            return b''
+        first = start // self.chunk_size
+        last = (stop - 1) // self.chunk_size
+        chunks = []
+        with open(self.filename, 'rb') as f:
+            for offset, length in self._offsets[first:last + 1]:
+                f.seek(offset)
+                chunks.append(f.read(length))
+        decompressed = b''.join(_map(get_codec(self.codec).decompress, chunks))
+        base = first * self.chunk_size
+        return decompressed[start - base:stop - base]
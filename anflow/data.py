@@ -2,14 +2,31 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import anydbm
+import bisect
+from collections import Iterator, OrderedDict, namedtuple
+import hashlib
+import io
 import operator
 import os
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 import shelve
+import sys
+import tempfile
+import threading
 import time
+import zlib
+
+import numpy as np
+
+from anflow import compression
+from anflow.utils import PicklableFunction, prefetch_map
 
 
 
@@ -32,6 +49,250 @@ def _aprx(x, y, rtol, atol):
     return abs(x - y) <= rtol * abs(y) + atol
 
 
+Serializer = namedtuple("Serializer", ("dumps", "loads"))
+
+serializers = {}
+
+
+def register_serializer(name, dumps, loads):
+    """Register a pair of functions for converting Datum payloads to and from
+    strings of bytes, which can then be selected by name"""
+    serializers[name] = Serializer(dumps, loads)
+
+
+def get_serializer(name):
+    """Retrieve the named serializer, raising a ValueError if it doesn't
+    exist"""
+    try:
+        return serializers[name]
+    except KeyError:
+        raise ValueError("Unknown serializer {}, expected one of {}"
+                         .format(name, sorted(serializers.keys())))
+
+
+def _pickle_dumps(data):
+    return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+
+def _numpy_dumps(data):
+    """Write numerical arrays in the raw NumPy format, pickling anything
+    else"""
+    if isinstance(data, np.ndarray) and data.dtype != object:
+        buf = io.BytesIO()
+        np.lib.format.write_array(buf, data)
+        return b'N' + buf.getvalue()
+    return b'P' + _pickle_dumps(data)
+
+
+def _numpy_loads(string):
+    if string[:1] == b'N':
+        return np.lib.format.read_array(io.BytesIO(string[1:]))
+    return pickle.loads(string[1:])
+
+
+def _zlib_serializer(level):
+    """Create a serializer that compresses pickled data with zlib using the
+    specified compression level"""
+    return (lambda data: zlib.compress(_pickle_dumps(data), level),
+            lambda string: pickle.loads(zlib.decompress(string)))
+
+
+register_serializer('pickle', _pickle_dumps, pickle.loads)
+register_serializer('numpy', _numpy_dumps, _numpy_loads)
+for level in range(1, 10):
+    register_serializer('zlib-{}'.format(level), *_zlib_serializer(level))
+
+
+class ArrayReference(object):
+    """Reference to an array payload stored in a separate .npy file, which is
+    loaded as a read-only memory map"""
+
+    def __init__(self, filename):
+        """Constructor - filename is relative to the directory containing the
+        file holding the reference"""
+        self.filename = filename
+
+    @classmethod
+    def dump(cls, data, filename):
+        """Save the supplied array to filename and return a reference to it"""
+        # Memory maps of an existing file would change underneath their
+        # readers if it were overwritten in place, so write to a temporary
+        # file and replace the existing one
+        handle, temp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(filename) or '.', suffix=".tmp")
+        with os.fdopen(handle, 'wb') as f:
+            np.save(f, data)
+        os.rename(temp_filename, filename)
+        return cls(os.path.basename(filename))
+
+    def load(self, directory):
+        """Memory map the referenced array"""
+        return np.load(os.path.join(directory, self.filename), mmap_mode='r')
+
+
+class CompressedReference(object):
+    """Reference to a payload compressed in chunks in a separate file. Arrays
+    are stored as raw bytes so that ranges of rows can be read without
+    decompressing the whole array"""
+
+    def __init__(self, filename, serializer=None, dtype=None, shape=None):
+        """Constructor - filename is relative to the directory containing the
+        file holding the reference"""
+        self.filename = filename
+        self.serializer = serializer
+        self.dtype = dtype
+        self.shape = shape
+
+    @classmethod
+    def dump(cls, data, filename, codec, level=6, serializer=None):
+        """Compress the supplied data into filename and return a reference to
+        it"""
+        if isinstance(data, np.ndarray) and data.dtype != object:
+            reference = cls(os.path.basename(filename), dtype=data.dtype.str,
+                            shape=data.shape)
+            string = np.ascontiguousarray(data).tostring()
+        else:
+            reference = cls(os.path.basename(filename), serializer)
+            if serializer is None:
+                string = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+            else:
+                string = get_serializer(serializer).dumps(data)
+        compression.write(filename, string, codec, level)
+        return reference
+
+    def load(self, directory):
+        """Decompress the referenced data"""
+        if self.shape is not None:
+            return self.read(directory)
+        string = compression.CompressedFile(
+            os.path.join(directory, self.filename)).read()
+        if self.serializer is None:
+            return pickle.loads(string)
+        return get_serializer(self.serializer).loads(string)
+
+    def read(self, directory, start=None, stop=None):
+        """Decompress the rows of the referenced array between start and
+        stop"""
+        if self.shape is None:
+            return self.load(directory)[start:stop]
+        dtype = np.dtype(self.dtype)
+        rows = range(*slice(start, stop).indices(self.shape[0]))
+        row_size = int(np.prod(self.shape[1:])) * dtype.itemsize
+        string = compression.CompressedFile(
+            os.path.join(directory, self.filename)).read(
+                rows[0] * row_size if rows else 0,
+                (rows[-1] + 1) * row_size if rows else 0)
+        return np.frombuffer(string, dtype).copy().reshape(
+            (len(rows),) + tuple(self.shape[1:]))
+
+
+def _dereference(payload, directory):
+    """Memory map the payload if it's stored in a separate .npy file, or
+    decompress it if it's stored in a compressed file"""
+    if isinstance(payload, (ArrayReference, CompressedReference)):
+        return payload.load(directory)
+    return payload
+
+
+def payload_size(data):
+    """Estimate the number of bytes of memory used by the supplied data"""
+    if isinstance(data, np.memmap):
+        # The operating system manages the memory of mapped files
+        return sys.getsizeof(data)
+    if isinstance(data, np.ndarray):
+        return sys.getsizeof(data) + data.nbytes
+    if isinstance(data, (list, tuple, set)):
+        return sys.getsizeof(data) + sum(payload_size(item) for item in data)
+    if isinstance(data, dict):
+        return sys.getsizeof(data) + sum(payload_size(item)
+                                         for item in data.items())
+    return sys.getsizeof(data)
+
+
+class PayloadCache(object):
+    """Process-wide least-recently-used cache of loaded payloads, keyed on an
+    identifier of where the payload is loaded from and its timestamp, so that
+    stale payloads are never returned. The total estimated size of the cached
+    payloads is kept below max_size bytes, and a max_size of zero disables
+    the cache"""
+
+    def __init__(self, max_size=0):
+        """Constructor"""
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, max_size):
+        """Remove the least recently used entries until the cache size is no
+        greater than max_size. Must be called with the lock held"""
+        while self._entries and self.size > max_size:
+            key, (payload, size) = self._entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+    def resize(self, max_size):
+        """Change the maximum size of the cache, evicting entries as
+        required"""
+        with self._lock:
+            self.max_size = max_size or 0
+            self._evict(self.max_size)
+
+    def clear(self):
+        """Empty the cache and reset the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self.size = self.hits = self.misses = self.evictions = 0
+
+    def get(self, source, timestamp, loader):
+        """Return the payload for the supplied source and timestamp, calling
+        loader to load it if it isn't in the cache. The source is any
+        hashable object identifying where the payload is loaded from"""
+        if not self.max_size or timestamp is None:
+            return loader()
+        key = (source, timestamp)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        payload = loader()
+        if isinstance(payload, Iterator):
+            # Streamed payloads can only be consumed once
+            return payload
+        size = payload_size(payload)
+        with self._lock:
+            if size <= self.max_size and key not in self._entries:
+                self._entries[key] = (payload, size)
+                self.size += size
+                self._evict(self.max_size)
+        return payload
+
+    def stats(self):
+        """Return a dictionary of the cache statistics"""
+        with self._lock:
+            return {'entries': len(self._entries), 'size': self.size,
+                    'max_size': self.max_size, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+payload_cache = PayloadCache()
+
+
+def _loader_key(loader):
+    """Identify a loader by its function and the arguments bound to it, so
+    that loaders reading the same files in different ways aren't confused"""
+    if isinstance(loader, PicklableFunction):
+        return (loader.func, repr(loader.args),
+                repr(sorted(loader.kwargs.items())))
+    return loader
+
+
 class FileWrapper(object):
     """Lazy file loading wrapper"""
 
@@ -47,21 +308,41 @@ class FileWrapper(object):
         try:
             return self._data
         except AttributeError:
-            self._data = self.loader(self.filename)
+            data = payload_cache.get((self.filename,
+                                      _loader_key(self.loader)),
+                                     self.timestamp,
+                                     lambda: self.loader(self.filename))
+            if isinstance(data, Iterator):
+                # Loaders that stream their data in chunks return a new
+                # iterator each time, so the data can't be kept
+                return data
+            self._data = data
             return self._data
 
 class Datum(object):
     """Holds a simulation result"""
 
-    _extensions = ['', '.bak', '.dat', '.dir', '.pag', '.db']
+    _extensions = ['', '.bak', '.dat', '.dir', '.pag', '.db', '.npy', '.z']
 
-    def __init__(self, params, data, file_prefix=None, path_template=None):
-        """Constructor"""
+    def __init__(self, params, data, file_prefix=None, path_template=None,
+                 store=None, mmap=False, serializer=None, compression=None,
+                 compression_level=6):
+        """Constructor - if a ResultStore is supplied, the datum is saved to
+        and loaded from the store rather than its own shelve file. If mmap is
+        True, array data is saved to a separate .npy file and loaded as a
+        memory map. If specified, serializer is the name of the registered
+        serializer used to save the data. If compression is the name of a
+        compression codec, the data is compressed into a separate .z file"""
 
         filename = generate_filename(params, file_prefix, ".pkl", path_template)
         self.filename = filename
         self._params = set(params.keys())
         self._data = data
+        self._store = store
+        self._mmap = mmap
+        self._serializer = serializer
+        self._compression = compression
+        self._compression_level = compression_level
         self.timestamp = None
 
         for key, value in params.items():
@@ -87,22 +368,76 @@ class Datum(object):
         try:
             return self._data
         except AttributeError:
-            shelf = shelve.open(self.filename, protocol=2)
-            self._data = shelf[b'data']
-            shelf.close()
+            self._data = payload_cache.get(self._source(), self.timestamp,
+                                           self._read_data)
             return self._data
 
+    def _source(self):
+        """Identify where the data is stored for the payload cache. The
+        results in a ResultStore share a file, so are told apart by their
+        parameters"""
+        if self._store is not None:
+            return (self._store.data_file, self._store.key(self.params))
+        return self.filename
+
+    def _read_data(self):
+        """Read the data from disk"""
+        if self._store is not None:
+            return self._store.read(self.params)
+        try:
+            shelf = shelve.open(self.filename, flag="r", protocol=2)
+        except anydbm.error:
+            raise IOError("No data found for datum in {}"
+                          .format(self.filename))
+        payload = shelf[b'data']
+        serializer = shelf.get(b'serializer')
+        shelf.close()
+        if serializer is not None:
+            payload = get_serializer(serializer).loads(payload)
+        return _dereference(payload, os.path.dirname(self.filename))
+
     def save(self):
         """Saves the datum to disk"""
+        if self._store is not None:
+            self.timestamp = self._store.append(self.params, self.data,
+                                                self._mmap, self._serializer)
+            return
         if not os.path.exists(os.path.dirname(self.filename)):
             os.makedirs(os.path.dirname(self.filename))
+        data = self.data
+        serializer = self._serializer
+        if self._mmap and isinstance(data, np.ndarray):
+            data = ArrayReference.dump(data, self.filename + '.npy')
+            serializer = None
+        elif self._compression is not None:
+            data = CompressedReference.dump(data, self.filename + '.z',
+                                            self._compression,
+                                            self._compression_level,
+                                            serializer)
+            serializer = None
+        elif serializer is not None:
+            data = get_serializer(serializer).dumps(data)
         shelf = shelve.open(self.filename, protocol=2)
         shelf[b'params'] = self.params
-        shelf[b'data'] = self.data
+        shelf[b'data'] = data
+        shelf[b'serializer'] = serializer
         self.timestamp = time.time()
         shelf[b'timestamp'] = self.timestamp
         shelf.close()
 
+    def read(self, start=None, stop=None):
+        """Read the rows of array data between start and stop. If the data is
+        compressed, only the chunks containing these rows are decompressed"""
+        if hasattr(self, '_data') or self._store is not None:
+            return self.data[start:stop]
+        shelf = shelve.open(self.filename, flag="r", protocol=2)
+        payload = shelf[b'data']
+        shelf.close()
+        directory = os.path.dirname(self.filename)
+        if isinstance(payload, CompressedReference):
+            return payload.read(directory, start, stop)
+        return self.data[start:stop]
+
     @classmethod
     def load(cls, filename):
         """Lazy-loads the object from disk"""
@@ -125,79 +460,446 @@ class Datum(object):
     def delete(self):
         """Deletes the datum file(s) on disk"""
 
+        if self._store is not None:
+            self._store.remove(self.params)
+            return
         for extension in self._extensions:
             try:
                 os.unlink(self.filename + extension)
             except OSError:
                 pass
 
+class BackgroundSaver(object):
+    """Saves Datum objects on a background thread so that computation can
+    overlap with writing results to disk. Datum objects are queued using
+    save, which blocks while the queue is full. The writer takes datums off
+    the queue in batches, creating the directories for each batch before
+    saving them"""
+
+    def __init__(self, maxsize, batch_size=32, callback=None):
+        """Constructor - starts the writer thread. If supplied, callback is
+        called with each Datum after it has been saved"""
+
+        self.batch_size = batch_size
+        self.callback = callback
+        self._queue = queue.Queue(maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._write)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _save_batch(self, batch):
+        """Save the supplied list of Datum objects"""
+        directories = set(os.path.dirname(datum.filename) for datum in batch
+                          if datum._store is None)
+        for directory in directories:
+            if directory and not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    pass
+        for datum in batch:
+            datum.save()
+            if self.callback is not None:
+                self.callback(datum)
+
+    def _write(self):
+        """Writer thread loop - a None on the queue stops the thread"""
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._save_batch([datum for datum in batch
+                                  if datum is not None])
+            except Exception as e:
+                self._error = self._error or e
+            for datum in batch:
+                self._queue.task_done()
+            if batch[-1] is None:
+                return
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, datum):
+        """Queue the supplied Datum to be saved"""
+        self._raise_error()
+        self._queue.put(datum)
+
+    def flush(self):
+        """Wait until all queued Datum objects have been saved"""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Save any queued Datum objects and stop the writer thread"""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+class ResultStore(object):
+    """Append-only store holding all the results of a model in a single data
+    file, alongside an index file mapping parameter combinations to the
+    location of each result in the data file"""
+
+    def __init__(self, path):
+        """Constructor - the data and index files are path with the extensions
+        .dat and .idx respectively"""
+
+        self.path = path
+        self.data_file = path + ".dat"
+        self.index_file = path + ".idx"
+        self._index = None
+
+    @staticmethod
+    def key(params):
+        """Generate the index key for the supplied parameters"""
+        return tuple(sorted(params.items()))
+
+    def index(self):
+        """Return the index of the store, mapping parameter keys to tuples of
+        (offset, length, timestamp, serializer), reading it from disk as
+        required"""
+        if self._index is None:
+            self._index = {}
+            try:
+                index_file = open(self.index_file, 'rb')
+            except IOError:
+                return self._index
+            with index_file:
+                while True:
+                    try:
+                        key, entry = pickle.load(index_file)
+                    except EOFError:
+                        break
+                    if entry is None:
+                        self._index.pop(key, None)
+                    else:
+                        self._index[key] = entry
+        return self._index
+
+    def _append_index(self, key, entry):
+        """Add an entry to the index file"""
+        with open(self.index_file, 'ab') as f:
+            pickle.dump((key, entry), f, 2)
+
+    def append(self, params, data, mmap=False, serializer=None):
+        """Append the supplied data to the store, returning the timestamp
+        of the new result. If mmap is True, array data is saved to a separate
+        .npy file and loaded as a memory map. Otherwise the data is written
+        using the named serializer, or pickled if there isn't one"""
+        index = self.index()
+        key = self.key(params)
+        directory = os.path.dirname(self.data_file)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        if mmap and isinstance(data, np.ndarray):
+            key_hash = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+            data = ArrayReference.dump(data, "{}.{}.npy".format(self.path,
+                                                                key_hash))
+            serializer = None
+        if serializer is None:
+            payload = pickle.dumps(data, 2)
+        else:
+            payload = get_serializer(serializer).dumps(data)
+        with open(self.data_file, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(payload)
+        entry = (offset, len(payload), time.time(), serializer)
+        self._append_index(key, entry)
+        index[key] = entry
+        return entry[2]
+
+    def read(self, params):
+        """Read the data for the supplied parameters"""
+        offset, length, timestamp, serializer = self.index()[self.key(params)]
+        with open(self.data_file, 'rb') as f:
+            f.seek(offset)
+            payload = f.read(length)
+        if serializer is None:
+            payload = pickle.loads(payload)
+        else:
+            payload = get_serializer(serializer).loads(payload)
+        return _dereference(payload, os.path.dirname(self.data_file))
+
+    def load(self, params):
+        """Lazy-loads the Datum for the supplied parameters, returning None if
+        there's no such result in the store"""
+        try:
+            timestamp = self.index()[self.key(params)][2]
+        except KeyError:
+            return None
+        new_datum = Datum(params, None, store=self)
+        delattr(new_datum, '_data')
+        new_datum.filename = self.data_file
+        new_datum.timestamp = timestamp
+        return new_datum
+
+    def remove(self, params):
+        """Remove the result with the supplied parameters from the index. The
+        data itself remains in the data file"""
+        key = self.key(params)
+        if self.index().pop(key, None) is not None:
+            self._append_index(key, None)
+
+    def __len__(self):
+        return len(self.index())
+
+def shelve_exists(filename):
+    """Check whether any of the files the shelve backend may have created for
+    filename exist"""
+    return any(os.path.exists(filename + extension)
+               for extension in ['', '.db', '.dat', '.dir', '.pag'])
+
+class Manifest(object):
+    """Record of the filenames, parameters and timestamps of the shelve files
+    holding the results of a model, so that Datum objects can be created
+    without opening each file. Filenames are stored relative to the directory
+    containing the manifest"""
+
+    basename = ".manifest"
+
+    def __init__(self, directory):
+        """Constructor"""
+
+        self.directory = directory
+        self.filename = os.path.join(directory, self.basename)
+        self._entries = None
+
+    def _key(self, filename):
+        return os.path.relpath(filename, self.directory)
+
+    def entries(self):
+        """Return the dictionary mapping filenames to tuples of parameters and
+        timestamp, reading the manifest file as required"""
+        if self._entries is None:
+            try:
+                with open(self.filename, 'rb') as f:
+                    self._entries = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                self._entries = {}
+        return self._entries
+
+    def add(self, datum):
+        """Add the supplied datum to the manifest"""
+        self.entries()[self._key(datum.filename)] = (datum.params,
+                                                     datum.timestamp)
+
+    def remove(self, filename):
+        """Remove the entry for the specified file from the manifest"""
+        self.entries().pop(self._key(filename), None)
+
+    def load(self, filename):
+        """Lazy-loads the Datum stored in the specified file, returning None
+        if the file isn't in the manifest. The file itself isn't checked"""
+        try:
+            params, timestamp = self.entries()[self._key(filename)]
+        except KeyError:
+            return None
+        new_datum = Datum(params, None)
+        delattr(new_datum, '_data')
+        new_datum.filename = filename
+        new_datum.timestamp = timestamp
+        return new_datum
+
+    def save(self):
+        """Write the manifest to disk"""
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        # Write to a temporary file first so readers never see a partially
+        # written manifest
+        handle, temp_filename = tempfile.mkstemp(dir=self.directory,
+                                                 suffix=".tmp")
+        with os.fdopen(handle, 'wb') as f:
+            pickle.dump(self.entries(), f, 2)
+        os.rename(temp_filename, self.filename)
+
+    def rebuild(self):
+        """Rebuild the manifest by scanning the directory for shelve files"""
+        self._entries = {}
+        filenames = set()
+        for directory, subdirs, files in os.walk(self.directory):
+            for f in files:
+                if ".pkl" in f:
+                    base = f[:f.index(".pkl") + len(".pkl")]
+                    filenames.add(os.path.join(directory, base))
+        for filename in filenames:
+            datum = Datum.load(filename)
+            if datum is not None:
+                self.add(datum)
+        self.save()
+
 class DataSet(object):
 
-    def __init__(self, params, config, prefix=None, path_template=None):
+    def __init__(self, params, config, prefix=None, path_template=None,
+                 store=None, manifest=None):
         """Constructor - initialize parameter set"""
         self.config = config
         self._params = params
         self._prefix = prefix
         self._template = path_template
-
-        self._counter = 0
+        self._store = store
+        self._manifest = manifest
+        self._index = None
     
     def filter(self, *args, **kwargs):
         """Filter the dataset according to the supplied kwargs"""
 
         query = Query(*args, **kwargs)
-        return DataSet(query.evaluate(self._params), self.config, self._prefix,
-                       self._template)
+        if self._index is None:
+            self._index = ParameterIndex(self._params)
+        return DataSet(self._index.evaluate(query), self.config, self._prefix,
+                       self._template, self._store, self._manifest)
+
+    def _load(self, params):
+        """Lazy-load the Datum with the supplied parameters, returning None if
+        it doesn't exist"""
+        if self._store is not None:
+            return self._store.load(params)
+        actual_prefix = os.path.join(self.config.RESULTS_DIR, self._prefix)
+        filename = generate_filename(params, actual_prefix, '.pkl',
+                                     self._template)
+        if self._manifest is not None:
+            datum = self._manifest.load(filename)
+            if datum is not None:
+                return datum
+        return Datum.load(filename)
+
+    def _load_with_data(self, params):
+        """Load the Datum with the supplied parameters along with its data"""
+        datum = self._load(params)
+        if datum is not None:
+            datum.data
+        return datum
+
+    def iterate(self, prefetch=None, load_data=False):
+        """Return a generator over the Datum objects in the dataset. If
+        prefetch is greater than zero, up to that many Datum objects are
+        loaded ahead of the one being consumed using a thread pool, along
+        with their data if load_data is True. The default is taken from the
+        DATASET_PREFETCH setting"""
+        if prefetch is None:
+            prefetch = getattr(self.config, 'DATASET_PREFETCH', 0)
+        load = self._load_with_data if load_data else self._load
+        for datum in prefetch_map(load, self._params, prefetch):
+            if datum is not None:
+                yield datum
 
     def all(self):
         """Return a list of all Datum objects matched by the current
         parameters"""
-        output = []
-        actual_prefix = os.path.join(self.config.RESULTS_DIR, self._prefix)
-        for params in self._params:
-            filename = generate_filename(params, actual_prefix, '.pkl',
-                                         self._template)
-            datum = Datum.load(filename)
-            if datum is not None:
-                output.append(datum)
-        return output
+        return list(self.iterate())
 
     def first(self):
         """Return the first item in the DataSet"""
-        actual_prefix = os.path.join(self.config.RESULTS_DIR, self._prefix)
         try:
-            filename = generate_filename(self._params[0], actual_prefix, '.pkl',
-                                         self._template)
+            params = self._params[0]
         except IndexError:
             return
-        try:
-            return Datum.load(filename)
-        except anydbm.error:
-            raise IOError("Unable to open shelve file {}".format(filename))
+        return self._load(params)
 
     def __iter__(self):
-        """Return the iterator for the dataset"""
-        return self
-
-    def next(self):
-        """Next function for iterating"""
-        if self._counter >= len(self._params):
-            self._counter = 0
-            raise StopIteration
-        else:
-            datum = None
-            while datum is None and self._counter < len(self._params):
-                actual_prefix = os.path.join(self.config.RESULTS_DIR, self._prefix)
-                filename = generate_filename(self._params[self._counter],
-                                             actual_prefix, '.pkl', self._template)
-                self._counter += 1
-                datum = Datum.load(filename)
-            return datum
+        """Return an independent iterator over the dataset"""
+        return self.iterate()
 
     def __len__(self):
         return len(self._params)
 
 
+class ParameterIndex(object):
+    """Indices over the values of each parameter in a list of parameter
+    dictionaries, used to evaluate queries without testing every parameter
+    combination. The indices for each parameter are built as they are
+    needed"""
+
+    def __init__(self, parameters):
+        """Constructor"""
+        self.parameters = parameters
+        self._hash_indices = {}
+        self._sorted_indices = {}
+
+    def _hash_index(self, name):
+        """Get the dictionary mapping values of the named parameter to the
+        positions of the parameters with that value"""
+        try:
+            return self._hash_indices[name]
+        except KeyError:
+            index = {}
+            for i, params in enumerate(self.parameters):
+                index.setdefault(params[name], set()).add(i)
+            self._hash_indices[name] = index
+            return index
+
+    def _sorted_index(self, name):
+        """Get the sorted values of the named parameter along with the
+        corresponding parameter positions"""
+        try:
+            return self._sorted_indices[name]
+        except KeyError:
+            pairs = sorted((params[name], i)
+                           for i, params in enumerate(self.parameters))
+            index = ([pair[0] for pair in pairs], [pair[1] for pair in pairs])
+            self._sorted_indices[name] = index
+            return index
+
+    def _filter_positions(self, func, name, value):
+        """Get the positions of the parameters satisfying a single filter"""
+        if func is operator.eq:
+            return set(self._hash_index(name).get(value, ()))
+
+        values, positions = self._sorted_index(name)
+        if func is operator.gt:
+            return set(positions[bisect.bisect_right(values, value):])
+        elif func is operator.ge:
+            return set(positions[bisect.bisect_left(values, value):])
+        elif func is operator.lt:
+            return set(positions[:bisect.bisect_left(values, value)])
+        elif func is operator.le:
+            return set(positions[:bisect.bisect_right(values, value)])
+        elif func is Query.comparison_map['aprx']:
+            tolerance = 1e-5 * abs(value) + 1e-8
+            start = bisect.bisect_left(values, value - tolerance)
+            end = bisect.bisect_right(values, value + tolerance)
+            return set(i for x, i in zip(values[start:end],
+                                         positions[start:end])
+                       if func(x, value))
+        raise TypeError("Cannot index filter function {}".format(func))
+
+    def _positions(self, query):
+        """Recurse through the query to get the set of positions of the
+        parameters it selects"""
+        if query.filter_func:
+            if query.filter_spec is None:
+                raise TypeError("Cannot index custom filter function")
+            positions = self._filter_positions(*query.filter_spec)
+        elif query.children:
+            positions = reduce(query.connector,
+                               [self._positions(child)
+                                for child in query.children])
+        else:
+            positions = set(range(len(self.parameters)))
+        if query.negate:
+            positions = set(range(len(self.parameters))) - positions
+        return positions
+
+    def evaluate(self, query):
+        """Return the list of parameters selected by the supplied query, in
+        the same order as Query.evaluate. Falls back to Query.evaluate if the
+        query can't be answered using the indices"""
+        try:
+            positions = self._positions(query)
+        except (KeyError, TypeError):
+            return query.evaluate(self.parameters)
+        return [self.parameters[i] for i in sorted(positions)]
+
+
 class Query(object):
     """Parameter filtering class using tree/node structure"""
 
@@ -230,12 +932,14 @@ class Query(object):
 
         self.connector = operator.and_
         self.filter_func = None
+        self.filter_spec = None
         self.negate = False
 
     def _set_filter(self, func, parameter_name, parameter_value):
         """Specify a filter function that returns True or False for a given
         parameter value"""
         self.filter_func = lambda d: func(d[parameter_name], parameter_value)
+        self.filter_spec = (func, parameter_name, parameter_value)
 
     def _recurse(self, parameters):
         """Recursively call _recurse on children to build up a list of True
@@ -253,11 +957,15 @@ class Query(object):
                 results = [True] * len(parameters)
         return [not result if self.negate else result for result in results]
 
+    def compile(self):
+        """Compile the query into a CompiledQuery"""
+        return CompiledQuery(self)
+
     def evaluate(self, parameters):
         """Evaluate which parameters we're keeping and which we're discarding,
         returning the list of parameter combinations that we do want to keep"""
 
-        results = self._recurse(parameters)
+        results = self.compile().mask(parameters)
         return [params for keep, params in zip(results, parameters) if keep]
 
     def __and__(self, other):
@@ -277,3 +985,135 @@ class Query(object):
         ret = type(self)(*self.children)
         ret.negate = not self.negate
         return ret
+
+
+class CompiledQuery(object):
+    """Flattened form of a Query tree. Lists of parameters are evaluated
+    using NumPy arrays of the values of each parameter, with the children of
+    each node only evaluated on the parameters that can still change the
+    result. Single parameter dictionaries can be tested by calling the
+    object"""
+
+    def __init__(self, query):
+        """Constructor"""
+        self.tree = self._flatten(query)
+
+    @classmethod
+    def _flatten(cls, query):
+        """Convert the query into nested tuples, merging nested nodes with
+        the same connector. Filters become ('filter', negate, func, name,
+        value) and other nodes ('node', negate, connector, children)"""
+        if query.filter_func:
+            if query.filter_spec is None:
+                return ('custom', query.negate, query.filter_func)
+            return ('filter', query.negate) + tuple(query.filter_spec)
+        if not query.children:
+            return ('node', query.negate, operator.and_, [])
+
+        children = []
+        for child in query.children:
+            flat_child = cls._flatten(child)
+            if (flat_child[0] == 'node' and not flat_child[1]
+                and flat_child[2] is query.connector and flat_child[3]):
+                children.extend(flat_child[3])
+            else:
+                children.append(flat_child)
+        if len(children) == 1 and query.connector in (operator.and_,
+                                                      operator.or_):
+            child = children[0]
+            return (child[0], child[1] != query.negate) + child[2:]
+        return ('node', query.negate, query.connector, children)
+
+    @staticmethod
+    def _column(parameters, name):
+        """Build an array of the values of the named parameter"""
+        values = [params[name] for params in parameters]
+        column = np.array(values)
+        if column.ndim != 1 or column.dtype.kind not in 'biuf':
+            column = np.empty(len(values), dtype=object)
+            column[:] = values
+        return column
+
+    def _mask(self, node, parameters, columns, rows):
+        """Evaluate the node on the parameters with the specified row
+        indices"""
+        kind, negate = node[:2]
+        if kind == 'custom':
+            result = np.array([bool(node[2](parameters[i])) for i in rows],
+                              dtype=bool)
+        elif kind == 'filter':
+            func, name, value = node[2:]
+            if np.isscalar(value):
+                try:
+                    column = columns[name]
+                except KeyError:
+                    column = columns[name] = self._column(parameters, name)
+                column = column[rows]
+                result = func(column, value)
+                if not (isinstance(result, np.ndarray)
+                        and result.shape == column.shape):
+                    result = [func(x, value) for x in column]
+            else:
+                # NumPy would compare sequences such as tuples element by
+                # element against the column, rather than as single values
+                result = [func(parameters[i][name], value) for i in rows]
+            result = np.asarray(result).astype(bool)
+        else:
+            connector, children = node[2:]
+            if connector is operator.and_:
+                # Only evaluate later children where all earlier ones pass
+                result = np.ones(len(rows), dtype=bool)
+                active = np.arange(len(rows))
+                for child in children:
+                    if len(active) == 0:
+                        break
+                    child_result = self._mask(child, parameters, columns,
+                                              rows[active])
+                    result[active] = child_result
+                    active = active[child_result]
+            elif connector is operator.or_:
+                # Only evaluate later children where all earlier ones fail
+                result = np.zeros(len(rows), dtype=bool)
+                pending = np.arange(len(rows))
+                for child in children:
+                    if len(pending) == 0:
+                        break
+                    child_result = self._mask(child, parameters, columns,
+                                              rows[pending])
+                    result[pending] = child_result
+                    pending = pending[~child_result]
+            else:
+                results = [self._mask(child, parameters, columns, rows)
+                           for child in children]
+                result = reduce(connector, results)
+        return ~result if negate else result
+
+    def mask(self, parameters):
+        """Return a boolean array specifying which of the supplied parameters
+        are selected by the query"""
+        return self._mask(self.tree, parameters, {},
+                          np.arange(len(parameters)))
+
+    def _test(self, node, params):
+        """Evaluate the node on a single parameter dictionary"""
+        kind, negate = node[:2]
+        if kind == 'custom':
+            result = bool(node[2](params))
+        elif kind == 'filter':
+            func, name, value = node[2:]
+            result = bool(func(params[name], value))
+        else:
+            connector, children = node[2:]
+            if connector is operator.and_:
+                result = all(self._test(child, params) for child in children)
+            elif connector is operator.or_:
+                result = any(self._test(child, params) for child in children)
+            else:
+                result = reduce(connector, [self._test(child, params)
+                                            for child in children])
+        return not result if negate else result
+
+    def __call__(self, params):
+        """Test whether the supplied parameter dictionary is selected by the
+        query"""
+        return self._test(self.tree, params)
@@ -1,16 +1,80 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+from collections import Iterator, OrderedDict
 import inspect
-from itertools import chain, product
+from itertools import chain, product, tee
+from multiprocessing.pool import ThreadPool
 import os
 import re
 
-from anflow.data import FileWrapper, Query
+from anflow.data import FileWrapper, Query, payload_size
+from anflow.utils import PicklableFunction, prefetch_map
+
+
+class MissingFilesError(IOError):
+    """Raised when input files don't exist, listing all the missing files"""
+
+    def __init__(self, filenames):
+        """Constructor"""
+        self.filenames = filenames
+        super(MissingFilesError, self).__init__(
+            "{} input file(s) missing: {}{}".format(
+                len(filenames), ", ".join(filenames[:10]),
+                ", ..." if len(filenames) > 10 else ""))
+
+
+def stat_files(filenames, workers=16):
+    """Get the modification times of the supplied files, returning a
+    dictionary mapping filenames to times. Each directory is listed once to
+    find the missing files, which are reported together in a
+    MissingFilesError, then the remaining files are stat'ed concurrently
+    using a thread pool with the specified number of workers"""
+
+    directories = OrderedDict()
+    for filename in filenames:
+        directory, basename = os.path.split(filename)
+        directories.setdefault(directory, []).append((filename, basename))
+
+    missing = []
+    existing = []
+    for directory, files in directories.items():
+        try:
+            contents = set(os.listdir(directory or '.'))
+        except OSError:
+            contents = set()
+        for filename, basename in files:
+            (existing if basename in contents else missing).append(filename)
+    if missing:
+        raise MissingFilesError(missing)
+
+    if workers > 1 and len(existing) > 1:
+        pool = ThreadPool(min(workers, len(existing)))
+        try:
+            timestamps = pool.map(os.path.getmtime, existing)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        timestamps = [os.path.getmtime(filename) for filename in existing]
+    return dict(zip(existing, timestamps))
+
+
+def _load_payload(filewrapper):
+    """Load the data of the supplied FileWrapper. This needs to be at module
+    level so that it can be used with a process pool"""
+    return filewrapper.data
 
 
 class Parser(object):
 
+    # The number of FileWrapper objects to load ahead of the one being used,
+    # whether to load them using 'thread' or 'process' workers, and an
+    # optional limit on the number of bytes of data loaded ahead
+    prefetch = 0
+    prefetch_executor = 'thread'
+    prefetch_memory = None
+
     def __init__(self):
         """Parser constructor"""
 
@@ -25,7 +89,29 @@ class Parser(object):
         """Parser iterator"""
         if not self.populated:
             self.populate()
-        return self.parsed_data.__iter__()
+        return self._prefetched(self.parsed_data)
+
+    def _prefetched(self, filewrappers):
+        """Iterate over the supplied FileWrapper objects, loading the data of
+        the next prefetch objects in the background"""
+        if not self.prefetch:
+            return iter(filewrappers)
+        filewrappers, to_load = tee(filewrappers)
+        payloads = prefetch_map(_load_payload, to_load, self.prefetch,
+                                executor=self.prefetch_executor,
+                                max_bytes=self.prefetch_memory,
+                                sizeof=payload_size)
+        return self._attach(filewrappers, payloads)
+
+    @staticmethod
+    def _attach(filewrappers, payloads):
+        """Attach the loaded data to the FileWrapper objects, which is only
+        necessary if they were loaded in another process"""
+        for filewrapper, payload in zip(filewrappers, payloads):
+            if not (hasattr(filewrapper, '_data')
+                    or isinstance(payload, Iterator)):
+                filewrapper._data = payload
+            yield filewrapper
 
     def __len__(self):
         """Length attribute"""
@@ -45,7 +131,7 @@ class CombinedParser(Parser):
 
     def __iter__(self):
         """Combine iterators from the two parsers"""
-        return chain(self.parser1, self.parser2)
+        return self._prefetched(chain(self.parser1, self.parser2))
 
     def __len__(self):
         """Total length is the sum of both iterators"""
@@ -54,6 +140,13 @@ class CombinedParser(Parser):
 
 class GuidedParser(Parser):
 
+    stat_workers = 16
+    # If streaming is True, iterating over an unpopulated parser yields each
+    # FileWrapper as soon as its files have been stat'ed, with the files
+    # stat'ed in batches in the background
+    streaming = False
+    stream_batch_size = 64
+
     def __init__(self, path_template, loader, parameters, **kwargs):
         """Constructor for the GuidedParser"""
         super(GuidedParser, self).__init__()
@@ -63,8 +156,9 @@ class GuidedParser(Parser):
         self.parameters = parameters
         self.auxparams = kwargs
 
-    def populate(self):
-        """Populate the parser using the data on the specified paths"""
+    def _templates(self):
+        """Generate tuples of parameters, the path template for the parameters
+        and the files that the template refers to"""
 
         path_template_copy = self.path_template
         # First the path template needs to be reformatted if there are variables
@@ -74,31 +168,86 @@ class GuidedParser(Parser):
                                         '{{{{{}}}}}'.format(key),
                                         path_template_copy)
 
-        # Now go through all non-collected parameters and set up FileWrapper for
-        # each
+        # Now go through all non-collected parameters and work out the files
+        # each depends on
         for params in self.parameters:
             sub_template = path_template_copy.format(**params)
-
-            timestamps = []
+            filenames = []
             for auxvalues in product(*self.auxparams.values()):
                 auxparamsdict = dict(zip(self.auxparams.keys(),
                                          auxvalues))
-                filename = sub_template.format(**auxparamsdict)
-                timestamps.append(os.path.getmtime(filename))
-            timestamp = max(timestamps)
-            def wrapped_loader(template):
-                return self.loader(template, **self.auxparams)
+                filenames.append(sub_template.format(**auxparamsdict))
+            yield params, sub_template, filenames
+
+    def _wrap(self, templates):
+        """Stat the files for the supplied list of templates in one go and
+        return a FileWrapper for each"""
+
+        all_filenames = [filename for params, sub_template, filenames
+                         in templates for filename in filenames]
+        timestamps = stat_files(all_filenames, self.stat_workers)
+
+        # Use a PicklableFunction so that the data can be loaded in another
+        # process
+        wrapped_loader = PicklableFunction(self.loader, **self.auxparams)
+        filewrappers = []
+        for params, sub_template, filenames in templates:
+            timestamp = max(timestamps[filename] for filename in filenames)
             filewrapper = FileWrapper(sub_template, wrapped_loader,
                                       timestamp=timestamp)
             filewrapper.params = params
-            self.parsed_data.append(filewrapper)
+            filewrappers.append(filewrapper)
+        return filewrappers
+
+    def _batches(self):
+        """Split the templates into batches of stream_batch_size"""
+        batch = []
+        for template in self._templates():
+            batch.append(template)
+            if len(batch) == self.stream_batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
+    def populate(self):
+        """Populate the parser using the data on the specified paths"""
+        self.parsed_data = self._wrap(list(self._templates()))
         self.populated = True
 
+    def stream(self):
+        """Generator that populates the parser, yielding each FileWrapper as
+        it's created. The next batch of files is stat'ed in the background
+        while the current one is consumed"""
+
+        parsed_data = []
+        for filewrappers in prefetch_map(self._wrap, self._batches(), 1):
+            for filewrapper in filewrappers:
+                parsed_data.append(filewrapper)
+                yield filewrapper
+        self.parsed_data = parsed_data
+        self.populated = True
+
+    def __iter__(self):
+        """Parser iterator, which streams the data if streaming is True and
+        the parser hasn't been populated"""
+        if self.streaming and not self.populated:
+            return self._prefetched(self.stream())
+        return super(GuidedParser, self).__iter__()
+
+    def __len__(self):
+        """The length is the number of parameter sets, so doesn't require the
+        parser to be populated"""
+        return len(self.parameters)
+
     def filter(self, *args, **kwargs):
         """Filter the parser data according to either a query or
         a list of parameters"""
         query = Query(*args, **kwargs)
-        return GuidedParser(self.path_template, self.loader,
-                            query.evaluate(self.parameters),
-                            **self.auxparams)
+        parser = GuidedParser(self.path_template, self.loader,
+                              query.evaluate(self.parameters),
+                              **self.auxparams)
+        for attr in ['streaming', 'prefetch', 'prefetch_executor',
+                     'prefetch_memory']:
+            setattr(parser, attr, getattr(self, attr))
+        return parser
@@ -7,18 +7,81 @@ from functools import wraps
 import json
 import hashlib
 import logging
+from multiprocessing import Pool, cpu_count, current_process
+from multiprocessing.pool import ThreadPool
 import os
+import threading
+import time
 
 import numpy as np
 
-from anflow.data import Datum
+from anflow.data import Datum, payload_size
 from anflow.management import load_project_config
+from anflow.utils import PicklableFunction
 
 
 
-ResamplerResult = collections.namedtuple("ResamplerResult",
-                                         ['data', 'centre',
-                                          'error', 'bins'])
+class ResamplerResult(collections.namedtuple("ResamplerResult",
+                                             ['data', 'centre', 'error',
+                                              'bins', 'kind'])):
+    """The result of a resampled measurement. kind is the name of the
+    resampling method, which determines how the covariance is normalised"""
+
+    normalisations = {'jackknife': lambda N: (N - 1) / N,
+                      'bootstrap': lambda N: 1 / N}
+
+    def __new__(cls, data, centre, error, bins, kind=None):
+        """Constructor - kind defaults to None for compatibility"""
+        return super(ResamplerResult, cls).__new__(cls, data, centre, error,
+                                                   bins, kind)
+
+    def _memoize(self, key, func):
+        """Compute the value of func once, storing it on the result"""
+        memo = self.__dict__.setdefault('_memo', {})
+        if key not in memo:
+            memo[key] = func()
+        return memo[key]
+
+    def covariance(self, shrinkage=0):
+        """Compute the covariance matrix of the flattened measurement, so
+        the diagonal holds the squared errors. If shrinkage is greater than
+        zero, the off-diagonal elements are scaled by (1 - shrinkage), which
+        improves the conditioning of matrices computed from few samples"""
+        if not 0 <= shrinkage <= 1:
+            raise ValueError("Shrinkage must be between 0 and 1")
+        try:
+            normalisation = self.normalisations[self.kind]
+        except KeyError:
+            raise ValueError("Can't compute the covariance of a result with "
+                             "kind {}".format(self.kind))
+
+        def compute():
+            samples = _stack(self.data)
+            if samples is None:
+                raise ValueError("Can't compute the covariance of "
+                                 "non-numerical samples")
+            N = len(samples)
+            deviations = (samples.reshape(N, -1)
+                          - np.asarray(self.centre).reshape(-1))
+            covariance = normalisation(N) * deviations.T.dot(deviations)
+            if shrinkage:
+                diagonal = np.diag(np.diag(covariance))
+                covariance = ((1 - shrinkage) * covariance
+                              + shrinkage * diagonal)
+            return covariance
+        return self._memoize(('covariance', shrinkage), compute)
+
+    def correlation(self, shrinkage=0):
+        """Compute the correlation matrix of the flattened measurement"""
+        def compute():
+            covariance = self.covariance(shrinkage)
+            errors = np.sqrt(np.diag(covariance))
+            return covariance / np.outer(errors, errors)
+        return self._memoize(('correlation', shrinkage), compute)
+
+BlockingAnalysis = collections.namedtuple("BlockingAnalysis",
+                                          ['binsizes', 'errors',
+                                           'tau_int', 'binsize'])
 
 def hashgen(hash_object):
     """Generate an md5 hash using the pickle value of the specified object"""
@@ -26,39 +89,318 @@ def hashgen(hash_object):
     return hashlib.md5(pickle_value).hexdigest()
 
 def cache_lookup(hash_object, base_path, timestamp):
+    """Look up cached data newer than timestamp, decompressing it if it was
+    cached with compression"""
     hash_value = hashgen(hash_object)
     file_path = os.path.join(base_path, hash_value + ".pkl")
-    if os.path.exists(file_path):
-        file_timestamp = os.path.getmtime(file_path)
-        if file_timestamp > timestamp:
-            return Datum.load(file_path).data
+    # The shelve backend may add its own extensions to the file name, so let
+    # Datum.load work out whether the file exists
+    datum = Datum.load(file_path)
+    if datum is not None and datum.timestamp > timestamp:
+        return datum.data
     return
 
 def cache_dump(hash_object, base_path, datum):
+    """Save the supplied datum to the cache, compressing it if the datum was
+    created with a compression codec"""
     hash_value = hashgen(hash_object)
     file_path = os.path.join(base_path, hash_value + ".pkl")
     datum.filename = file_path
     datum.save()
 
+class ResamplerCache(object):
+    """Cache of resampled data. Recently used samples are kept in memory in a
+    least-recently-used cache shared by all resamplers, in front of the
+    on-disk cache of Datum files. The total estimated size of the samples
+    kept in memory is kept below max_size bytes, and a max_size of zero
+    disables the in-memory cache. Hits and misses are counted and logged"""
+
+    max_size = 2**28
+    _size = 0
+    _memory = collections.OrderedDict()
+    _lock = threading.Lock()
+    counters = collections.Counter()
+
+    def __init__(self, path=None, compression=None, compression_level=6):
+        """Constructor - if path is None, only the in-memory cache is used"""
+
+        self.path = path
+        self.compression = compression
+        self.compression_level = compression_level
+        self.log = logging.getLogger('anflow.resamplers.cache')
+
+    def _count(self, event):
+        with self._lock:
+            self.counters[event] += 1
+        self.log.info("Resampler cache {} (hits in memory: {}, hits on disk: "
+                      "{}, misses: {})"
+                      .format(event.replace('_', ' '),
+                              self.counters['memory_hit'],
+                              self.counters['disk_hit'],
+                              self.counters['miss']))
+
+    @classmethod
+    def _evict(cls, max_size):
+        """Remove the least recently used entries until the in-memory cache
+        size is no greater than max_size. Must be called with the lock
+        held"""
+        while cls._memory and cls._size > max_size:
+            key, (timestamp, payload, size) = cls._memory.popitem(last=False)
+            cls._size -= size
+
+    @classmethod
+    def resize(cls, max_size):
+        """Change the maximum size of the in-memory cache, evicting entries as
+        required"""
+        with cls._lock:
+            cls.max_size = max_size or 0
+            cls._evict(cls.max_size)
+
+    @classmethod
+    def _remember(cls, key, payload):
+        """Add the payload to the in-memory cache, evicting the least recently
+        used entries as required"""
+        size = payload_size(payload)
+        with cls._lock:
+            entry = cls._memory.pop(key, None)
+            if entry is not None:
+                cls._size -= entry[2]
+            if size <= cls.max_size:
+                cls._memory[key] = (time.time(), payload, size)
+                cls._size += size
+                cls._evict(cls.max_size)
+
+    def lookup(self, key, timestamp):
+        """Return the payload cached with the supplied key if it's newer than
+        timestamp, otherwise None"""
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                self._memory[key] = entry
+        if entry is not None and entry[0] > timestamp:
+            self._count('memory_hit')
+            return entry[1]
+
+        payload = None
+        if self.path is not None:
+            payload = cache_lookup(key, self.path, timestamp)
+        if payload is None:
+            self._count('miss')
+            return
+        self._count('disk_hit')
+        self._remember(key, payload)
+        return payload
+
+    def store(self, key, params, payload):
+        """Cache the supplied payload in memory and, if there's a cache path,
+        on disk"""
+        self._remember(key, payload)
+        if self.path is not None:
+            datum = Datum(params, payload, compression=self.compression,
+                          compression_level=self.compression_level)
+            cache_dump(key, self.path, datum)
+
+    @classmethod
+    def clear(cls):
+        """Empty the in-memory cache and reset the counters"""
+        with cls._lock:
+            cls._memory.clear()
+            cls._size = 0
+            cls.counters.clear()
+
+_bins_cache = collections.OrderedDict()
+_bins_cache_lock = threading.Lock()
+_bins_cache_size = 8
+
+def generate_bins(N, num_bootstraps, seed=None):
+    """Generate a (num_bootstraps, N) array of bootstrap bins, using the
+    smallest unsigned integer type that can hold the indices. If a seed is
+    specified, the bins are generated using a dedicated random number
+    generator with that seed, and are cached so that all the observables
+    resampled with the same seed share the same read-only array of bins"""
+
+    dtype = np.min_scalar_type(max(N - 1, 0))
+    if seed is None:
+        return np.random.randint(N, size=(num_bootstraps, N)).astype(dtype)
+    key = (N, num_bootstraps, seed)
+    with _bins_cache_lock:
+        bins = _bins_cache.pop(key, None)
+        if bins is None:
+            rng = np.random.RandomState(seed)
+            bins = rng.randint(N, size=(num_bootstraps, N)).astype(dtype)
+            bins.flags.writeable = False
+        _bins_cache[key] = bins
+        while len(_bins_cache) > _bins_cache_size:
+            _bins_cache.popitem(last=False)
+    return bins
+
 def bin_data(data, binsize):
-    return [sum(data[i:i+binsize]) / binsize
-            for i in range(0, len(data) - binsize + 1, binsize)]
+    """Average the supplied data in consecutive bins of binsize samples,
+    discarding any samples left over at the end. Numerical data is binned by
+    reshaping it into (N / binsize, binsize, ...) and averaging the second
+    axis"""
+    if binsize == 1 and isinstance(data, np.ndarray):
+        # Avoid copying, which would read in the whole of memory-mapped data
+        return data
+    stacked = data if isinstance(data, np.ndarray) else _stack(data)
+    if stacked is None:
+        return [sum(data[i:i+binsize]) / binsize
+                for i in range(0, len(data) - binsize + 1, binsize)]
+    num_bins = len(stacked) // binsize
+    binned_data = (stacked[:num_bins * binsize]
+                   .reshape((num_bins, binsize) + stacked.shape[1:])
+                   .mean(axis=1))
+    if isinstance(data, np.ndarray):
+        # Keep array data as an (N, ...) array for the vectorized resamplers
+        return binned_data
+    return list(binned_data)
+
+def bin_stream(chunks, binsize):
+    """Generator that bins the samples in the supplied iterable of chunks of
+    samples, yielding an array of the complete bins in each chunk. Samples
+    are carried over to the next chunk where a bin straddles two chunks, so
+    only one chunk needs to be held in memory at a time"""
+    remainder = None
+    for chunk in chunks:
+        chunk = np.asarray(chunk)
+        if remainder is not None and len(remainder):
+            chunk = np.concatenate([remainder, chunk])
+        num_samples = len(chunk) // binsize * binsize
+        remainder = chunk[num_samples:]
+        if num_samples:
+            yield bin_data(chunk[:num_samples], binsize)
+
+def blocking_analysis(data, min_blocks=16):
+    """Estimate the error on the mean of the supplied (N, ...) series of
+    samples as a function of binsize, by repeatedly averaging neighbouring
+    pairs of samples (Flyvbjerg and Petersen, J. Chem. Phys. 91, 461). The
+    binsize is doubled until fewer than min_blocks bins remain. The chosen
+    binsize is the smallest at which the error of every element agrees with
+    the errors at all larger binsizes, within their statistical uncertainty.
+    Returns a BlockingAnalysis holding the binsizes, the (levels, ...) array
+    of errors, the integrated autocorrelation time of each element and the
+    chosen binsize"""
+
+    blocked = np.asarray(data, dtype=float)
+    binsizes, errors, uncertainties = [], [], []
+    binsize = 1
+    while len(blocked) >= min_blocks:
+        N = len(blocked)
+        error = np.sqrt(blocked.var(axis=0, ddof=1) / N)
+        binsizes.append(binsize)
+        errors.append(error)
+        uncertainties.append(error / np.sqrt(2 * (N - 1)))
+        half = N // 2
+        blocked = (blocked[:2 * half:2] + blocked[1:2 * half:2]) / 2
+        binsize *= 2
+    if not binsizes:
+        raise ValueError("Blocking analysis needs at least {} samples"
+                         .format(min_blocks))
+    errors = np.array(errors)
+    uncertainties = np.array(uncertainties)
+
+    level = len(binsizes) - 1
+    for i in range(len(binsizes)):
+        if np.all(errors[i:] - errors[i] <= 2 * uncertainties[i:]):
+            level = i
+            break
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau_int = np.where(errors[0] > 0,
+                           (errors[level] / errors[0])**2 / 2, 0.5)
+    return BlockingAnalysis(binsizes, errors, tau_int, binsizes[level])
+
+def _replace_data(datum, data):
+    """Copy the supplied datum, replacing its data"""
+    new_datum = Datum(datum.params, data)
+    new_datum.filename = datum.filename
+    new_datum.timestamp = datum.timestamp
+    return new_datum
+
+def _bin_streamed(data, binsize):
+    """Bin the chunks of data yielded by the iterator returned by a loader,
+    returning a Datum holding the binned data in place of the input"""
+    chunks = list(bin_stream(data.data, binsize))
+    return _replace_data(data, np.concatenate(chunks) if chunks
+                         else np.array([]))
+
+def _stack(data):
+    """Try to convert the supplied sequence of samples into an (N, ...)
+    numerical array, returning None if this isn't possible"""
+    try:
+        stacked = np.asarray(data)
+    except (TypeError, ValueError):
+        return None
+    if stacked.dtype == object or stacked.ndim == 0:
+        return None
+    return stacked
+
+class JackknifeSamples(object):
+    """Lazy sequence of leave-one-out samples of an (N, ...) array. Each
+    sample is generated from an index array when it's requested, so the N
+    samples are never held in memory simultaneously"""
+
+    def __init__(self, data):
+        """Constructor"""
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, i):
+        N = len(self.data)
+        if i < 0:
+            i += N
+        if not 0 <= i < N:
+            raise IndexError("Jackknife sample index out of range")
+        indices = np.arange(N - 1)
+        indices[i:] += 1
+        return self.data[indices]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __sizeof__(self):
+        """Include the data the samples are generated from"""
+        return object.__sizeof__(self) + payload_size(self.data)
 
 class Resampler(object):
     """Base resampling class"""
 
+    executors = {'thread': ThreadPool, 'process': Pool}
+    # The name of the resampling method, used to normalise covariances
+    kind = None
+
     def __init__(self, resample=True, average=False, binsize=1, cache_path=None,
-                 error_name=None):
+                 error_name=None, executor=None, workers=None, chunksize=1,
+                 compression=None, compression_level=6, vectorized=False):
         """Constructor - creates the resampling object and the cache directory as
-        required"""
+        required. If executor is 'thread' or 'process', the function is applied
+        to the samples concurrently using a pool of the specified number of
+        workers. If compression is the name of a compression codec, resampled
+        data is compressed in the cache. If binsize is 'auto', the binsize is
+        chosen using a blocking analysis of the data, which is stored in the
+        blocking attribute. If vectorized is True, the function is called once
+        with an (N, ...) array of all the samples and should return an array
+        of N results"""
 
+        if executor is not None and executor not in self.executors:
+            raise ValueError("Unknown executor {}, expected one of {}"
+                             .format(executor, sorted(self.executors.keys())))
         self.average = average
         self.binsize = binsize
         self._cache_path = cache_path
         self._cache = cache_path and resample
         self.do_resample = resample
         self.error_name = error_name
+        self.executor = executor
+        self.workers = workers
+        self.chunksize = chunksize
+        self.compression = compression
+        self.compression_level = compression_level
+        self.vectorized = vectorized
         self.bins = None
+        self.blocking = None
         self.log = logging.getLogger('anflow.resamplers.{}'
                                      .format(self.__class__.__name__))
 
@@ -83,62 +425,106 @@ class Resampler(object):
             else:
                 self._cache_path = self._cache_path or config.CACHE_PATH
                 self._cache = self._cache_path and self.do_resample
+                if self.compression is None:
+                    self.compression = getattr(config, 'CACHE_COMPRESSION',
+                                               None)
+                    self.compression_level = getattr(
+                        config, 'CACHE_COMPRESSION_LEVEL',
+                        self.compression_level)
+                memory_size = getattr(config, 'CACHE_MEMORY_SIZE', None)
+                if memory_size is not None:
+                    ResamplerCache.resize(memory_size)
             if self.do_resample:
-                # Do the resampling as required
-                hash_object = (data.filename, self.average, self.binsize,
-                               self.__class__.__name__)
-                # Check for cached data
-                self.log.info("Checking cache for resampled data")
-                working_data = cache_lookup(hash_object, self._cache_path,
-                                            data.timestamp)
-                if not working_data:
-                    self.log.info("No cached data")
-                    self.log.info("Resampling")
+                # Do the resampling as required. Data that hasn't been loaded
+                # from disk can't be identified, so isn't cached. The cache
+                # is checked before the data is read, so that a hit doesn't
+                # need to read the data at all
+                cache = None
+                if self._cache and data.timestamp is not None:
+                    cache = ResamplerCache(self._cache_path, self.compression,
+                                           self.compression_level)
+                    key = self.cache_key(data)
+                    # Check for cached data
+                    self.log.info("Checking cache for resampled data")
+                    cached = cache.lookup(key, data.timestamp)
+                else:
+                    cached = None
+                if cached is None:
                     # Resample data if it's not in the cache
+                    data, binsize, streamed = self._prepare(data)
+                    self.log.info("Resampling")
                     working_data = self._resample(bin_data(data.data,
-                                                           self.binsize))
-                    if self._cache:
-                        # Dump resampled data to cache if necessary
-                        cache_dump(hash_object, self._cache_path,
-                                   Datum(data.params, working_data))
+                                                           binsize))
+                    if cache is not None:
+                        payload = {'samples': working_data, 'bins': self.bins,
+                                   'blocking': self.blocking}
+                        if streamed:
+                            # The stream can't be read again to compute the
+                            # central value, so keep the data read from it
+                            payload['data'] = data.data
+                        cache.store(key, data.params, payload)
+                else:
+                    working_data = cached['samples']
+                    self.bins = cached['bins']
+                    self.blocking = cached.get('blocking')
+                    if 'data' in cached:
+                        data = _replace_data(data, cached['data'])
             else:
                 # If not resampling, then data is just the input data
                 working_data = data.data
+            # The output of another resampled model already holds samples,
+            # which are kept together as a stacked array where possible
+            chained = (not self.do_resample
+                       and isinstance(working_data, ResamplerResult))
+            if chained:
+                input_result = working_data
+                stacked = _stack(input_result.data)
+                working_data = (input_result.data if stacked is None
+                                else stacked)
 
             if self.error_name:
                 # If an error argument name is specified, add the error to
                 # the kwargs
                 try:
-                    kwargs[self.error_name] = data.error
+                    kwargs[self.error_name] = (input_result.error if chained
+                                               else data.error)
                 except AttributeError:
                     # If there's no error in the input, compute it.
-                    
-                    input_centre = sum(working_data) / len(working_data)
+                    if isinstance(working_data, np.ndarray):
+                        input_centre = working_data.mean(axis=0)
+                    else:
+                        input_centre = sum(working_data) / len(working_data)
                     kwargs[self.error_name] = self._error(working_data,
                                                           input_centre)
-            results = []
-            N = len(working_data)
-            for i, datum in enumerate(working_data):
-                self.log.info("Applying function to sample {} of {}".format(i + 1, N))
-                result = function(datum, *args, **kwargs)
-                if result is None:
-                    self.log.warning("Measurement on sample returned None")
-                    return
-                results.append(result)
-            if len(results) == 0:
+            results = self._apply(function, working_data, args, kwargs)
+            if results is None or len(results) == 0:
                 return
-            if type(data.data) == ResamplerResult:
-                centre_data = data.data
+            centre_data = input_result if chained else data
+            if self.vectorized:
+                # The function expects a stack of samples, so give it a stack
+                # of one. Bootstrap applies the function to the mean of the
+                # results, which may have fewer dimensions than a sample, in
+                # which case the function can reduce away the stack axis
+                def central_function(datum):
+                    stack = np.asarray(datum)[np.newaxis]
+                    result = np.asarray(function(stack, *args, **kwargs))
+                    if result.ndim == 0:
+                        return result[()]
+                    if len(result) == 1:
+                        return result[0]
+                    return result
             else:
-                centre_data = data
+                def central_function(datum):
+                    return function(datum, *args, **kwargs)
             self.log.info("Applying function to central value")
             centre = self._central_value(centre_data, results,
-                                         lambda datum: function(datum, *args,
-                                                                **kwargs))
+                                         central_function)
             self.log.info("Computing error")
             error = self._error(results, centre)
-            result_datum = ResamplerResult(data=results, centre=centre,
-                                           error=error, bins=self.bins)
+            result_datum = ResamplerResult(
+                data=results, centre=centre, error=error,
+                bins=input_result.bins if chained else self.bins,
+                kind=self.kind)
             return result_datum
 
         decorator.original = function
@@ -147,6 +533,111 @@ class Resampler(object):
 
         return decorator
 
+    def _prepare(self, data):
+        """Read the supplied data ready for binning, returning the datum to
+        resample, the binsize to use and whether the data was streamed. If
+        the binsize is 'auto', it's chosen by a blocking analysis, falling
+        back to a binsize of one if there's too little data for this"""
+        binsize = self.binsize
+        streamed = isinstance(data.data, collections.Iterator)
+        if binsize == 'auto':
+            if streamed:
+                # The analysis needs the whole series
+                data = _bin_streamed(data, 1)
+            try:
+                self.blocking = blocking_analysis(data.data)
+            except ValueError as e:
+                self.blocking = None
+                self.log.warning("{}, so not binning the data".format(e))
+                return data, 1, streamed
+            binsize = self.blocking.binsize
+            self.log.info("Blocking analysis chose binsize {}"
+                          .format(binsize))
+            for size, error in zip(self.blocking.binsizes,
+                                   self.blocking.errors):
+                self.log.debug("Binsize {}: error {}".format(size, error))
+            self.log.info("Integrated autocorrelation time: {}"
+                          .format(self.blocking.tau_int))
+        elif streamed:
+            # The loader streams the data in chunks, so bin it as it's read
+            # rather than holding the raw series in memory
+            data = _bin_streamed(data, binsize)
+            binsize = 1
+        return data, binsize, streamed
+
+    def _key_params(self):
+        """Parameters specific to the resampling method that affect the
+        resampled data"""
+        return ()
+
+    def cache_key(self, data):
+        """Generate the cache key for the resampled version of the supplied
+        data, which depends on all the resampling parameters"""
+        return ((self.__class__.__name__, data.filename, self.average,
+                 self.binsize) + self._key_params())
+
+    def _apply(self, function, samples, args, kwargs):
+        """Apply the function to each of the samples, returning the list of
+        results, or None if the function returns None on any sample"""
+
+        N = len(samples)
+        if self.vectorized:
+            stacked = _stack(samples)
+            if stacked is not None:
+                self.log.info("Applying function to {} samples at once"
+                              .format(N))
+                results = function(stacked, *args, **kwargs)
+                if results is None:
+                    self.log.warning("Measurement on samples returned None")
+                    return
+                return np.asarray(results)
+            self.log.warning("Samples can't be stacked, so applying function "
+                             "to each in turn")
+        if self.executor is None:
+            results = []
+            for i, datum in enumerate(samples):
+                self.log.info("Applying function to sample {} of {}"
+                              .format(i + 1, N))
+                result = function(datum, *args, **kwargs)
+                if result is None:
+                    self.log.warning("Measurement on sample returned None")
+                    return
+                results.append(result)
+            return results
+
+        executor = self.executor
+        if executor == 'process' and current_process().daemon:
+            # The workers of a parallel model run are daemonic, and daemonic
+            # processes can't have children
+            self.log.warning("Can't start a process pool from a daemonic "
+                             "process, so using a thread pool instead")
+            executor = 'thread'
+        self.log.info("Applying function to {} samples using {} pool"
+                      .format(N, executor))
+        function = PicklableFunction(function, *args, **kwargs)
+        workers = self.workers or cpu_count()
+        # The pool takes samples as fast as they can be generated, so feed it
+        # a window of samples at a time to avoid generating them all at once
+        window = 4 * workers * self.chunksize
+        pool = self.executors[executor](workers)
+        results = []
+        try:
+            for start in range(0, N, window):
+                window_samples = (samples[i]
+                                  for i in range(start, min(start + window, N)))
+                # Pool.imap preserves the order of the samples
+                for result in pool.imap(function, window_samples,
+                                        self.chunksize):
+                    if result is None:
+                        self.log.warning("Measurement on sample returned "
+                                         "None")
+                        return
+                    results.append(result)
+        finally:
+            pool.terminate()
+            pool.join()
+        return results
+
     def _resample(self, data):
         raise NotImplementedError
 
@@ -159,9 +650,13 @@ class Resampler(object):
 
 class Jackknife(Resampler):
 
+    kind = 'jackknife'
+
     def _central_value(self, data, results, function):
         if self.do_resample:
             if self.average:
+                if isinstance(data.data, np.ndarray):
+                    return function(data.data.mean(axis=0))
                 return function(sum(data.data) / len(data.data))
             else:
                 return function(data.data)
@@ -171,12 +666,22 @@ class Jackknife(Resampler):
     @staticmethod
     def _error(data, centre):
         N = len(data)
+        stacked = _stack(data)
+        if stacked is not None:
+            deviations = (stacked - centre)**2
+            return np.sqrt((N - 1) / N * deviations.sum(axis=0))
         deviations = map(lambda datum: (datum - centre)**2, data)
         return ((N - 1) / N * sum(deviations))**0.5
 
     def _resample(self, data):
 
         N = len(data)
+        if isinstance(data, np.ndarray):
+            if self.average:
+                # Leave-one-out averages from the total sum, without copies
+                return (data.sum(axis=0) - data) / (N - 1)
+            else:
+                return JackknifeSamples(data)
         if self.average:
             data_sum = sum(data)
             resampled_data = [(data_sum - datum) / (N - 1) for datum in data]
@@ -186,27 +691,58 @@ class Jackknife(Resampler):
 
 class Bootstrap(Resampler):
 
+    kind = 'bootstrap'
+
     def __init__(self, resample=True, average=False, binsize=1, bins=None,
-                 num_bootstraps=None, cache_path=None, error_name=None):
-        """Initialize the bootstrap variables - bins and/or num_bootstraps"""
+                 num_bootstraps=None, cache_path=None, error_name=None,
+                 executor=None, workers=None, chunksize=1, compression=None,
+                 compression_level=6, seed=None, vectorized=False):
+        """Initialize the bootstrap variables - bins and/or num_bootstraps. If
+        a seed is specified, the bins are generated from it for each dataset,
+        so resamplers with the same seed use the same bins for data of the
+        same length"""
 
         super(Bootstrap, self).__init__(resample, average, binsize, cache_path,
-                                        error_name)
-        if not (bins or num_bootstraps):
+                                        error_name, executor, workers,
+                                        chunksize, compression,
+                                        compression_level, vectorized)
+        if bins is None and not num_bootstraps:
             raise ValueError("You must specify either the bins to use or the "
                              "number of bootstraps")
         else:
             self.bins = bins
             self.num_bootstraps = num_bootstraps or len(bins)
+            self.seed = seed
+        # The bins generated on first use replace self.bins, so the supplied
+        # bins are identified by their hash when the resampler is created
+        if seed is not None or bins is None:
+            self._bins_hash = None
+        else:
+            bins = np.asarray(bins, dtype=np.int64)
+            self._bins_hash = hashlib.md5(bins.tostring()).hexdigest()
+
+    def _key_params(self):
+        """The bins determine the bootstrap samples, so these are included by
+        seed, by the hash of the supplied bins, or by number if they're
+        generated on first use. Generated bins are cached along with the
+        samples, so every call with the same parameters finds the same
+        samples"""
+        return (self.num_bootstraps, self.seed, self._bins_hash)
 
     def _central_value(self, data, results, function):
         """Central value computation"""
+        if isinstance(results, np.ndarray):
+            return function(results.mean(axis=0))
         return function(sum(results) / len(results))
 
     @staticmethod
     def _error(data, centre):
         """Error computation"""
         N = len(data)
+        stacked = _stack(data)
+        if stacked is not None:
+            deviations = (stacked - centre)**2
+            return np.sqrt(deviations.sum(axis=0) / N)
         deviations = map(lambda datum: (datum - centre)**2, data)
         return (1 / N * sum(deviations))**0.5
 
@@ -214,9 +750,25 @@ class Bootstrap(Resampler):
         """Resample the supplied data"""
 
         N = len(data)
-        if not self.bins:
-            self.bins = [np.random.randint(N, size=N).tolist()
-                         for i in range(self.num_bootstraps)]
+        if self.seed is not None:
+            self.bins = generate_bins(N, self.num_bootstraps, self.seed)
+        elif self.bins is None:
+            self.bins = generate_bins(N, self.num_bootstraps)
+        if isinstance(data, np.ndarray):
+            bins = np.asarray(self.bins)
+            if self.average:
+                # Bootstrap averages as a product of the per-sample bin
+                # counts with the data, avoiding the (B, N, ...) copy
+                num_samples = len(bins)
+                offsets = N * np.arange(num_samples)[:, np.newaxis]
+                counts = np.bincount((bins + offsets).ravel(),
+                                     minlength=num_samples * N)
+                counts = counts.reshape(num_samples, N)
+                flat_data = data.reshape(N, -1)
+                averages = counts.dot(flat_data) / bins.shape[1]
+                return averages.reshape((num_samples,) + data.shape[1:])
+            else:
+                return data[bins]
         resampled_data = [[data[i] for i in sample_bins]
                           for sample_bins in self.bins]
         if self.average:
@@ -0,0 +1,149 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import logging
+from multiprocessing.pool import ThreadPool
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class Scheduler(object):
+    """Runs the parsers, models and views of a simulation in dependency order,
+    running independent branches of the dependency graph concurrently. Views
+    change the working directory of the process, so are run on their own.
+    Models are only run with more than one process when branches aren't run
+    concurrently, since forking from the scheduler's threads can leave the
+    child processes deadlocked on locks held by other threads"""
+
+    def __init__(self, simulation, parameters=None, queries=None, workers=1,
+                 model_workers=None, force=False):
+        """Constructor - parameters and queries are dictionaries keyed by model
+        and view tags, as returned by anflow.xml.simulation_from_etree"""
+
+        self.simulation = simulation
+        self.parameters = parameters or {}
+        self.queries = queries or {}
+        self.workers = workers
+        self.model_workers = model_workers
+        self.force = force
+        self.log = logging.getLogger('anflow.scheduler')
+        if workers > 1 and model_workers is not None and model_workers > 1:
+            self.log.warning("Running models with one process, as {} "
+                             "branches are run concurrently"
+                             .format(workers))
+            self.model_workers = 1
+
+    def build_graph(self):
+        """Build the dependency graph of the simulation, returning an ordered
+        dictionary mapping each node to the set of nodes it depends on. Nodes
+        are tuples of the form (kind, tag), where kind is one of 'parser',
+        'model' or 'view'"""
+
+        sim = self.simulation
+        graph = OrderedDict()
+        for tag in sim.parsers.keys():
+            graph[('parser', tag)] = set()
+
+        def input_node(tag):
+            if tag in sim.models:
+                return ('model', tag)
+            elif tag in sim.parsers:
+                return ('parser', tag)
+            elif tag in sim.results:
+                return None
+            raise KeyError("Tag {} does not exist".format(tag))
+
+        for tag, model in sim.models.items():
+            graph[('model', tag)] = set([input_node(model.input_tag)])
+        for tag, view in sim.views.items():
+            graph[('view', tag)] = set([input_node(input_tag)
+                                        for input_tag in view.input_tags])
+        for dependencies in graph.values():
+            dependencies.discard(None)
+
+        self._check_acyclic(graph)
+        return graph
+
+    @staticmethod
+    def _check_acyclic(graph):
+        """Raise a ValueError if the supplied graph contains a cycle"""
+        remaining = dict((node, set(deps)) for node, deps in graph.items())
+        while remaining:
+            ready = [node for node, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError("Dependency cycle between {}"
+                                 .format(sorted(remaining.keys())))
+            for node in ready:
+                remaining.pop(node)
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    def _run_node(self, node):
+        """Run the supplied node, returning the node and any exception
+        raised"""
+        kind, tag = node
+        sim = self.simulation
+        try:
+            if kind == 'parser':
+                parser = sim.parsers[tag]
+                # Streaming parsers are populated as the models use them
+                if not (getattr(parser, 'populated', True)
+                        or getattr(parser, 'streaming', False)):
+                    parser.populate()
+            elif kind == 'model':
+                sim.run_model(tag, self.parameters.get(tag),
+                              self.queries.get(tag),
+                              workers=self.model_workers, force=self.force)
+            else:
+                sim.run_view(tag, self.parameters.get(tag),
+                             self.queries.get(tag))
+        except Exception as e:
+            self.log.exception("Error running {} {}".format(kind, tag))
+            return node, e
+        return node, None
+
+    def run(self):
+        """Run the simulation, starting each node as soon as the nodes it
+        depends on have completed"""
+
+        remaining = self.build_graph()
+        completed = queue.Queue()
+        pool = ThreadPool(self.workers)
+        num_running = 0
+        view_running = False
+        error = None
+        try:
+            while (remaining and error is None) or num_running:
+                if error is None and not view_running:
+                    ready = [node for node, deps in remaining.items()
+                             if not deps]
+                    for node in ready:
+                        if node[0] == 'view':
+                            # Wait for everything else to finish first
+                            if num_running:
+                                continue
+                            view_running = True
+                        remaining.pop(node)
+                        self.log.info("Starting {} {}".format(*node))
+                        pool.apply_async(self._run_node, (node,),
+                                         callback=completed.put)
+                        num_running += 1
+                        if view_running:
+                            break
+                node, node_error = completed.get()
+                num_running -= 1
+                if node[0] == 'view':
+                    view_running = False
+                self.log.info("Finished {} {}".format(*node))
+                error = error or node_error
+                for deps in remaining.values():
+                    deps.discard(node)
+        finally:
+            pool.close()
+            pool.join()
+
+        if error is not None:
+            raise error
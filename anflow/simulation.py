@@ -1,18 +1,24 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-from collections import OrderedDict, namedtuple
+from collections import Iterator, OrderedDict, namedtuple
 import inspect
-from itertools import product
 import logging
 import os
 
+import numpy as np
+
+from anflow.cache import ResultCache, datum_hash, function_hash
 from anflow.config import Config
-from anflow.data import DataSet, Datum, Query, generate_filename
-from anflow.utils import get_root_path, get_dependency_files
+from anflow.data import (BackgroundSaver, DataSet, Datum, Manifest, Query,
+                         ResultStore, generate_filename, get_serializer,
+                         payload_cache, shelve_exists)
+from anflow.utils import (get_root_path, get_dependency_files,
+                          PicklableFunction, prefetch_map)
 
 
-Model = namedtuple("Model", ("func", "input_tag", "path_template", "load_only"))
+Model = namedtuple("Model", ("func", "input_tag", "path_template", "load_only",
+                             "serializer"))
 View = namedtuple("View", ("func", "input_tags", "output_dir"))
 
 
@@ -32,13 +38,48 @@ def gather_function_args(func):
     return args
 
 
+def detach_datum(datum):
+    """Copies the supplied input datum into a Datum object holding its data,
+    so that it can be sent to a process pool. Data streamed in chunks by a
+    loader can't be sent to another process, so the chunks are read and
+    joined into a single array"""
+    data = datum.data
+    if isinstance(data, Iterator):
+        chunks = [np.asarray(chunk) for chunk in data]
+        data = np.concatenate(chunks) if chunks else np.array([])
+    detached = Datum(datum.params, data)
+    detached.filename = datum.filename
+    detached.timestamp = datum.timestamp
+    return detached
+
+
+def _call_model(job):
+    """Runs a single model job, returning the job metadata with the result and
+    whether the model was actually run. Jobs with no function already have a
+    result, which is None if the stored result is up to date. This needs to
+    be at module level so that it can be used with a process pool"""
+    func, data, kwargs, meta = job
+    if func is None:
+        return meta, data, False
+    return meta, func(data, **kwargs), True
+
+
 class Simulation(object):
     defaults = {'DEBUG': False,
                 'LOGGING_LEVEL': logging.NOTSET,
                 'LOGGING_CONSOLE': True,
                 'LOGGING_FORMAT': "%(asctime)s : %(name)s : %(levelname)s : %(message)s",
                 'LOGGING_DATEFMT': "%d/%m/%Y %H:%M:%S",
-                'LOGGING_FILE': None}
+                'LOGGING_FILE': None,
+                'RESULT_CACHE_PATH': None,
+                'RESULT_CACHE_SIZE': None,
+                'RESULTS_STORE': 'shelve',
+                'RESULTS_MMAP': False,
+                'RESULTS_COMPRESSION': None,
+                'RESULTS_COMPRESSION_LEVEL': 6,
+                'DATASET_PREFETCH': 0,
+                'SAVE_QUEUE_SIZE': 0,
+                'PAYLOAD_CACHE_SIZE': 0}
 
     def __init__(self, import_name, root_path=None):
         """Constructor"""
@@ -74,6 +115,14 @@ class Simulation(object):
             fh.setFormatter(formatter)
             log.addHandler(fh)
 
+    def _setup_payload_cache(self, log):
+        """Resize the process-wide payload cache and log its statistics"""
+        payload_cache.resize(self.config.PAYLOAD_CACHE_SIZE)
+        if payload_cache.max_size:
+            log.info("Payload cache: {entries} entries, {size} of {max_size} "
+                     "bytes, {hits} hits, {misses} misses, {evictions} "
+                     "evictions".format(**payload_cache.stats()))
+
     def _get_input(self, tag):
         """Look in parsers for the specified input tag, and if it's not there
         then look in results"""
@@ -88,26 +137,45 @@ class Simulation(object):
         self.parsers[tag] = parser
 
     def register_model(self, model_tag, func, input_tag, path_template=None,
-                       load_only=False):
-        """Register the supplied model function and associated parameters"""
+                       load_only=False, serializer=None):
+        """Register the supplied model function and associated parameters. If
+        specified, serializer is the name of the registered serializer used to
+        save the results of the model"""
+        if serializer is not None:
+            get_serializer(serializer)
         self.models[model_tag] = Model(func, input_tag, path_template,
-                                       load_only)
+                                       load_only, serializer)
 
     def register_view(self, view_tag, func, input_tags, output_dir=None):
         """Returns a decorator to register the designated view"""
         # Adapt this so it's not a decorator
         self.views[view_tag] = View(func, input_tags, output_dir)
 
-    def run_model(self, model_tag, parameters=None, query=None, dry_run=False):
-        """Run a model"""
+    def _dependency_timestamp(self, func):
+        """Get the latest modification time of the source files under the
+        simulation root path that the supplied function depends on"""
+        files = get_dependency_files(getattr(func, 'original', func),
+                                     self.root_path)
+        return max([os.path.getmtime(f) for f in files] or [0])
+
+    def run_model(self, model_tag, parameters=None, query=None, dry_run=False,
+                  workers=None, force=False):
+        """Run a model. If workers is greater than one, the model is run on the
+        various parameter combinations using a process pool of that size, with
+        the results saved as they're returned. Parameter combinations with
+        stored results newer than both the input data and the source files of
+        the model are skipped, unless force is True"""
 
         self._setup_log()
         log = self.log.getChild('models.{}'.format(model_tag))
         log.info("Preparing to run model {}".format(model_tag))
+        self._setup_payload_cache(log)
 
-        func, input_tag, path_template, load_only = self.models[model_tag]
+        func, input_tag, path_template, load_only, serializer = \
+            self.models[model_tag]
         parameters = parameters or [{}]
-        query = query or Query()
+        predicate = (query or Query()).compile()
+        parallel = workers is not None and workers > 1
 
         data = self._get_input(input_tag)
         args = gather_function_args(func)
@@ -120,46 +188,169 @@ class Simulation(object):
             os.makedirs(results_dir)
         except OSError:
             pass
+        manifest = None
+        if self.config.RESULTS_STORE == 'consolidated':
+            store = ResultStore(os.path.join(results_dir, "results"))
+        elif self.config.RESULTS_STORE == 'shelve':
+            store = None
+            manifest = Manifest(results_dir)
+        else:
+            raise ValueError("Unknown results store {}"
+                             .format(self.config.RESULTS_STORE))
+
+        if not (force or load_only):
+            dependency_timestamp = self._dependency_timestamp(func)
+        if self.config.RESULT_CACHE_PATH and not load_only:
+            cache = ResultCache(self.config.RESULT_CACHE_PATH,
+                                self.config.RESULT_CACHE_SIZE)
+            func_hash = function_hash(func, self.root_path)
+        else:
+            cache = None
+        model_func = PicklableFunction(func) if parallel else func
+        datum_options = dict(
+            mmap=self.config.RESULTS_MMAP, serializer=serializer,
+            compression=self.config.RESULTS_COMPRESSION,
+            compression_level=self.config.RESULTS_COMPRESSION_LEVEL)
 
         log.info("Running model")
         num_runs = len(data) * len(parameters)
         dataset_params = []
-        for i, (datum, params) in enumerate(product(data, parameters)):
-            if not query.evaluate([datum.params]):
-                # If query filters out the datum parameters, skip
-                continue
-            # Construct the function arguments from the given parameters
-            joint_params = datum.params.copy()
-            joint_params.update(params)
-            # Retrieve values, falling back to defaults where they exist
-            kwargs = dict([(key, joint_params.get(key, args[key]))
-                           for key in args.keys()])
 
-            log.info("Running model ({} of {}):"
-                     .format(i + 1, num_runs))
-            for key, value in joint_params.items():
-                log.info("{}: {}".format(key, value))
-            if load_only:
-                dataset_params.append(joint_params)
-            else:
+        def load_result(joint_params):
+            if store is not None:
+                return store.load(joint_params)
+            filename = generate_filename(joint_params, results_dir + "/",
+                                         ".pkl", path_template)
+            result_datum = manifest.load(filename)
+            if result_datum is not None and not shelve_exists(filename):
+                # The result was deleted since the manifest was written, so
+                # drop the entry and compute the result again
+                manifest.remove(filename)
+                result_datum = None
+            if result_datum is None:
+                result_datum = Datum.load(filename)
+                if result_datum is not None:
+                    manifest.add(result_datum)
+            return result_datum
+
+        def up_to_date(datum, joint_params):
+            if force or datum.timestamp is None:
+                return False
+            result_datum = load_result(joint_params)
+            if result_datum is None:
+                return False
+            return result_datum.timestamp > max(datum.timestamp,
+                                                dependency_timestamp)
+
+        def combinations():
+            # Unlike itertools.product, this doesn't need to consume the
+            # input data before the first job can run
+            for datum in data:
+                for params in parameters:
+                    yield datum, params
+
+        def generate_jobs():
+            # The input hash is the same for all the parameters used with a
+            # datum, and combinations keeps these together, so only hash the
+            # input data when it changes
+            hashed_datum, input_hash = None, None
+            for i, (datum, params) in enumerate(combinations()):
+                if not predicate(datum.params):
+                    # If query filters out the datum parameters, skip
+                    continue
+                # Construct the function arguments from the given parameters
+                joint_params = datum.params.copy()
+                joint_params.update(params)
+                # Retrieve values, falling back to defaults where they exist
+                kwargs = dict([(key, joint_params.get(key, args[key]))
+                               for key in args.keys()])
+
+                log.info("Running model ({} of {}):"
+                         .format(i + 1, num_runs))
+                for key, value in joint_params.items():
+                    log.info("{}: {}".format(key, value))
+                if load_only:
+                    dataset_params.append(joint_params)
+                    continue
+                if up_to_date(datum, joint_params):
+                    log.info("Results are up to date, skipping")
+                    yield None, None, None, (joint_params, None)
+                    continue
+                cache_key = None
+                if cache is not None:
+                    if datum is not hashed_datum:
+                        hashed_datum, input_hash = datum, datum_hash(datum)
+                    cache_key = cache.key(func_hash, input_hash, joint_params)
+                    try:
+                        result = cache.lookup(cache_key)
+                    except KeyError:
+                        log.info("No cached result")
+                    else:
+                        log.info("Using cached result")
+                        yield None, result, None, (joint_params, None)
+                        continue
                 # TODO: Fix this in accordance with resampler config
                 if hasattr(func, 'resampled'):
-                    result = func(datum, **kwargs)
+                    model_input = detach_datum(datum) if parallel else datum
                 else:
-                    result = func(datum.data, **kwargs)
-                if result is not None:
+                    model_input = datum.data
+                    if parallel and isinstance(model_input, Iterator):
+                        # Streamed chunks can't be sent to another process
+                        model_input = list(model_input)
+                yield (model_func, model_input, kwargs,
+                       (joint_params, cache_key))
+
+        if self.config.SAVE_QUEUE_SIZE and not (dry_run or load_only):
+            log.info("Saving results in the background")
+            saver = BackgroundSaver(self.config.SAVE_QUEUE_SIZE,
+                                    callback=manifest and manifest.add)
+        else:
+            saver = None
+
+        if parallel:
+            log.info("Using a pool of {} processes".format(workers))
+            # The jobs are generated here rather than by the pool, so errors
+            # loading the input data are raised in this process, and only a
+            # few jobs are held in memory at a time
+            results = prefetch_map(_call_model, generate_jobs(), 2 * workers,
+                                   workers, executor='process')
+        else:
+            results = (_call_model(job) for job in generate_jobs())
+
+        try:
+            for (joint_params, cache_key), result, computed in results:
+                if not (computed or result is not None):
+                    dataset_params.append(joint_params)
+                elif result is not None:
                     dataset_params.append(joint_params)
+                    if cache_key is not None:
+                        cache.store(cache_key, result)
                     if not dry_run:
                         log.info("Saving results")
                         result_datum = Datum(joint_params, result,
                                              results_dir + "/",
-                                             path_template)
-                        result_datum.save()
+                                             path_template, store,
+                                             **datum_options)
+                        if saver is not None:
+                            saver.save(result_datum)
+                        else:
+                            result_datum.save()
+                            if manifest is not None:
+                                manifest.add(result_datum)
                 elif not dry_run:
                     log.info("Dry run, so no results saved")
+        finally:
+            # Stops the pool if the results weren't all used
+            results.close()
+            if saver is not None:
+                # Make sure all the results are on disk before they're used
+                saver.close()
+            if manifest is not None and not load_only:
+                manifest.save()
 
         self.results[model_tag] = DataSet(dataset_params, self.config,
-                                          results_dir + "/", path_template)
+                                          results_dir + "/", path_template,
+                                          store, manifest)
 
     def run_view(self, view_tag, parameters=None, queries=None):
         """Runs the specified view"""
@@ -167,6 +358,7 @@ class Simulation(object):
         self._setup_log()
         log = self.log.getChild("view.{}".format(view_tag))
         log.info("Preparing to run view {}".format(view_tag))
+        self._setup_payload_cache(log)
 
         func, input_tags, output_dir = self.views[view_tag]
         parameters = parameters or [{}]
@@ -183,8 +375,19 @@ class Simulation(object):
             pass
 
         log.info("Running view")
+        # The working directory is shared by all the threads of the process,
+        # so the Scheduler doesn't run anything else while a view is running
         old_cwd = os.getcwd()
         os.chdir(reports_dir)
+        try:
+            self._run_view_parameters(log, func, args, input_tags,
+                                      parameters, queries)
+        finally:
+            os.chdir(old_cwd)
+
+    def _run_view_parameters(self, log, func, args, input_tags, parameters,
+                             queries):
+        """Runs the view function on each of the supplied parameters"""
         for params in parameters:
             data = {}
             # Iterate through the input models and compile a dictionary
@@ -204,4 +407,4 @@ class Simulation(object):
             else:
                 log.info("Running view without parameters")
             func(data, **kwargs)
-        os.chdir(old_cwd)
+
@@ -9,6 +9,18 @@ import time
 
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 CACHE_PATH = 'cache'
+RESULT_CACHE_PATH = None
+RESULT_CACHE_SIZE = None
+RESULTS_STORE = 'shelve'
+RESULTS_MMAP = False
+RESULTS_COMPRESSION = None
+RESULTS_COMPRESSION_LEVEL = 6
+CACHE_COMPRESSION = None
+CACHE_COMPRESSION_LEVEL = 6
+CACHE_MEMORY_SIZE = 2**28
+DATASET_PREFETCH = 0
+SAVE_QUEUE_SIZE = 0
+PAYLOAD_CACHE_SIZE = 0
 
 LOGGING_LEVEL = logging.INFO
 LOGGING_CONSOLE = True
@@ -1,6 +1,10 @@
 from __future__ import absolute_import
 
+from collections import deque
+import importlib
 import inspect
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import os
 import pkgutil
 import re
@@ -74,4 +78,82 @@ def extract_from_format(format, string):
     string"""
     format_regex = re.sub(r'\{ *(?P<var>\w+) *\}', r'(?P<\g<var>>.+)',
                           format.replace('.', '\.'))
-    return re.match(format_regex, string)
\ No newline at end of file
+    return re.match(format_regex, string)
+
+def prefetch_map(func, iterable, size, workers=None, executor='thread',
+                 max_bytes=None, sizeof=None):
+    """Generator that applies func to each item of iterable, yielding the
+    results in order. If size is greater than zero, func is applied on a
+    thread pool, or a process pool if executor is 'process', with no more
+    than size results computed ahead of the one being consumed. If max_bytes
+    is specified, no more work is started while the results waiting to be
+    consumed take up more than max_bytes, as measured by sizeof"""
+
+    if not size:
+        for item in iterable:
+            yield func(item)
+        return
+
+    pool = (Pool if executor == 'process' else ThreadPool)(workers or size)
+    pending = deque()
+    sizes = {}
+
+    def over_budget():
+        """Check whether the completed results exceed max_bytes"""
+        if max_bytes is None:
+            return False
+        for result in pending:
+            if result.ready() and result not in sizes:
+                sizes[result] = sizeof(result.get())
+        return sum(sizes.values()) > max_bytes
+
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            while pending and (len(pending) > size or over_budget()):
+                result = pending.popleft()
+                sizes.pop(result, None)
+                yield result.get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class PicklableFunction(object):
+    """Wraps a function and some arguments so they can be sent to a process
+    pool. The function is pickled by reference, and functions that have been
+    replaced in their module by a decorator are recovered using the
+    decorator's original attribute"""
+
+    def __init__(self, func, *args, **kwargs):
+        """Constructor"""
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self, *args, **kwargs):
+        """Call the function with the supplied arguments appended to the
+        stored ones"""
+        full_kwargs = self.kwargs.copy()
+        full_kwargs.update(kwargs)
+        return self.func(*(args + self.args), **full_kwargs)
+
+    def __getstate__(self):
+        """Replace the function with its module and name"""
+        state = self.__dict__.copy()
+        modname = self.func.__module__
+        funcname = self.func.__name__
+        mod_func = getattr(sys.modules.get(modname), funcname, None)
+        unwrap = (mod_func is not self.func
+                  and getattr(mod_func, 'original', None) is self.func)
+        state['func'] = (modname, funcname, unwrap)
+        return state
+
+    def __setstate__(self, state):
+        """Look up the function using its module and name"""
+        modname, funcname, unwrap = state['func']
+        func = getattr(importlib.import_module(modname), funcname)
+        state['func'] = func.original if unwrap else func
+        self.__dict__.update(state)
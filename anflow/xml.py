@@ -130,6 +130,8 @@ def parser_from_elem(sim, elem, data_root):
 
     # Now register the parser
     parser = GuidedParser(path_template, loader_func, parameters, **collect)
+    parser.streaming = elem.get('streaming', 'false').lower() == 'true'
+    parser.prefetch = int(elem.get('prefetch', 0))
     sim.register_parser(parser_tag, parser)
 
 
@@ -141,7 +143,9 @@ def model_from_elem(sim, elem):
     parameters = parameters_from_elem(elem.find('./parameters'))
 
     load_only = True if elem.find('./load_only') else False
-    sim.register_model(model_tag, func, input_tag, load_only=load_only)
+    serializer = elem.get('serializer')
+    sim.register_model(model_tag, func, input_tag, load_only=load_only,
+                       serializer=serializer)
     return model_tag, parameters, query
 
 
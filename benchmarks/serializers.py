@@ -0,0 +1,77 @@
+"""Compares the write and read throughput and file sizes of the Datum
+serializers against the default shelve storage
+
+Usage: python benchmarks/serializers.py [repeats]
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from anflow.data import Datum, serializers
+
+
+def payloads():
+    """The kinds of data typically returned by models"""
+    return {'array': np.random.random((200, 64, 4)),
+            'nested list': np.random.random((200, 64)).tolist(),
+            'dict': dict(('key{}'.format(i), np.random.random(256))
+                         for i in range(100))}
+
+
+def file_size(filename):
+    """Total size of the files making up a shelve"""
+    directory = os.path.dirname(filename)
+    return sum(os.path.getsize(os.path.join(directory, f))
+               for f in os.listdir(directory)
+               if f.startswith(os.path.basename(filename)))
+
+
+def benchmark(data, serializer, repeats, directory):
+    """Time saving and loading the data with the supplied serializer,
+    returning the write time, read time and size of the data on disk"""
+    prefix = os.path.join(directory, serializer or 'shelve') + '_'
+    write_time = read_time = 0.0
+    for i in range(repeats):
+        datum = Datum({'i': i}, data, prefix, serializer=serializer)
+        start = time.time()
+        datum.save()
+        write_time += time.time() - start
+        start = time.time()
+        Datum.load(datum.filename).data
+        read_time += time.time() - start
+        size = file_size(datum.filename)
+        datum.delete()
+    return write_time / repeats, read_time / repeats, size
+
+
+def main(argv):
+    repeats = int(argv[0]) if argv else 5
+    directory = tempfile.mkdtemp()
+    try:
+        for name, data in sorted(payloads().items()):
+            print(name)
+            print("{:>10} {:>12} {:>12} {:>12}"
+                  .format("serializer", "write (s)", "read (s)", "size (kB)"))
+            for serializer in [None] + sorted(serializers.keys()):
+                write_time, read_time, size = benchmark(
+                    data, serializer, repeats, directory)
+                print("{:>10} {:>12.5f} {:>12.5f} {:>12.1f}"
+                      .format(serializer or 'shelve', write_time, read_time,
+                              size / 1024))
+            print()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import shutil
+
+import pytest
+
+from anflow.cache import ResultCache, datum_hash, function_hash
+from anflow.data import Datum
+
+
+
+def some_func(data):
+    return data
+
+
+@pytest.fixture
+def cache(tmp_dir, request):
+    cache_path = os.path.join(tmp_dir, "result_cache")
+    request.addfinalizer(lambda: shutil.rmtree(cache_path, ignore_errors=True))
+    return ResultCache(cache_path)
+
+class TestFunctions(object):
+
+    def test_function_hash(self, tmp_dir):
+        """Test function_hash"""
+        assert function_hash(some_func, tmp_dir) == function_hash(some_func,
+                                                                  tmp_dir)
+        assert (function_hash(some_func, tmp_dir)
+                != function_hash(datum_hash, tmp_dir))
+
+    def test_datum_hash(self):
+        """Test datum_hash"""
+        datum = Datum({'a': 1}, [1.0, 2.0])
+        assert datum_hash(datum) == datum_hash(Datum({'a': 1}, [1.0, 2.0]))
+        assert datum_hash(datum) != datum_hash(Datum({'a': 2}, [1.0, 2.0]))
+        assert datum_hash(datum) != datum_hash(Datum({'a': 1}, [1.0, 3.0]))
+
+class TestResultCache(object):
+
+    def test_init(self, cache, tmp_dir):
+        """Test ResultCache constructor"""
+        assert os.path.exists(os.path.join(tmp_dir, "result_cache"))
+        assert cache.max_size is None
+
+    def test_key(self):
+        """Test ResultCache.key"""
+        key = ResultCache.key('foo', 'bar', {'a': 1, 'b': 2})
+        assert key == ResultCache.key('foo', 'bar', {'b': 2, 'a': 1})
+        assert key != ResultCache.key('foo', 'bar', {'a': 1, 'b': 3})
+
+    def test_lookup_store(self, cache):
+        """Test ResultCache.lookup and ResultCache.store"""
+        with pytest.raises(KeyError):
+            cache.lookup('abcdef')
+        cache.store('abcdef', [1, 2, 3])
+        assert cache.lookup('abcdef') == [1, 2, 3]
+        assert cache.stats()['entries'] == 1
+
+    def test_prune(self, cache):
+        """Test ResultCache.prune"""
+        for i, key in enumerate(['aa', 'bb', 'cc']):
+            cache.store(key, list(range(100)))
+            os.utime(cache._filename(key), (i, i))
+        entry_size = cache.stats()['size'] // 3
+        cache.lookup('aa')
+        assert cache.prune(2 * entry_size) == 1
+        with pytest.raises(KeyError):
+            cache.lookup('bb')
+        assert cache.lookup('aa') == list(range(100))
+
+        cache.max_size = entry_size
+        cache.store('dd', list(range(100)))
+        assert cache.stats()['entries'] == 1
+        assert cache.lookup('dd') == list(range(100))
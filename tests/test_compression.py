@@ -0,0 +1,67 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from multiprocessing import Pool
+import os
+
+import numpy as np
+import pytest
+
+from anflow.compression import CompressedFile, compress, get_codec, write
+
+
+
+@pytest.fixture
+def compressed_file(tmp_dir, request):
+    filename = os.path.join(tmp_dir, "compressed.z")
+    string = np.random.random(1000).tostring()
+    write(filename, string, 'zlib', 6, chunk_size=1000)
+    request.addfinalizer(lambda: os.unlink(filename))
+    return {'filename': filename, 'string': string}
+
+def compress_in_chunks(string):
+    return compress(string, 'zlib', 6, chunk_size=3000)
+
+class TestFunctions(object):
+
+    def test_compress(self):
+        """Test compress"""
+        string = b'abcdefgh' * 1000
+        for codec in ['zlib', 'bz2']:
+            chunks = compress(string, codec, 9, chunk_size=3000)
+            assert len(chunks) == 3
+            decompress = get_codec(codec).decompress
+            assert b''.join(decompress(chunk) for chunk in chunks) == string
+        with pytest.raises(ValueError):
+            compress(string, 'some_non_existant_codec')
+
+    def test_compress_forked(self):
+        """Test that compress works in a process forked after the thread
+        pool was created"""
+        string = b'abcdefgh' * 1000
+        chunks = compress_in_chunks(string)
+        pool = Pool(1)
+        try:
+            result = pool.apply_async(compress_in_chunks, (string,))
+            assert result.get(timeout=10) == chunks
+        finally:
+            pool.terminate()
+            pool.join()
+
+class TestCompressedFile(object):
+
+    def test_init(self, compressed_file):
+        """Test CompressedFile constructor"""
+        f = CompressedFile(compressed_file['filename'])
+        assert f.codec == 'zlib'
+        assert f.chunk_size == 1000
+        assert len(f) == len(compressed_file['string'])
+
+    def test_read(self, compressed_file):
+        """Test CompressedFile.read"""
+        f = CompressedFile(compressed_file['filename'])
+        string = compressed_file['string']
+        assert f.read() == string
+        for start, stop in [(0, 10), (995, 1005), (1500, 4500), (7990, 9000),
+                            (5, 5)]:
+            assert f.read(start, stop) == string[start:stop]
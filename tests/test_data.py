@@ -9,12 +9,18 @@ except ImportError:
     import pickle
 import random
 import shelve
+import shutil
 import time
 
+import numpy as np
 import pytest
 
 from anflow.config import Config
-from anflow.data import _aprx, generate_filename, FileWrapper, Datum, DataSet, Query
+from anflow.data import (_aprx, generate_filename, BackgroundSaver,
+                         CompiledQuery, FileWrapper, Datum, DataSet, Manifest,
+                         ParameterIndex, PayloadCache, Query, ResultStore,
+                         get_serializer, payload_cache, payload_size,
+                         serializers)
 
 from .utils import count_shelve_files, delete_shelve_files
 
@@ -92,6 +98,21 @@ def random_dataset(request, tmp_dir):
     return {'dataset': dataset, 'params': all_params}
 
 
+@pytest.fixture
+def result_store(tmp_dir, request):
+
+    path = os.path.join(tmp_dir, 'store', 'results')
+    store = ResultStore(path)
+    all_params = [{'a': a, 'b': b} for a in range(3) for b in range(2)]
+    for params in all_params:
+        store.append(params, [params['a'], params['b']])
+
+    request.addfinalizer(lambda: shutil.rmtree(os.path.dirname(path),
+                                               ignore_errors=True))
+
+    return {'store': store, 'path': path, 'params': all_params}
+
+
 @pytest.fixture
 def random_parameters():
     return [{'a': a, 'b': b, 'c': c}
@@ -138,6 +159,58 @@ class TestFilewrapper(object):
         assert hasattr(random_wrapper['wrapper'], '_data')
         assert random_wrapper['wrapper']._data == random_wrapper['data']
 
+class TestPayloadCache(object):
+
+    def test_get(self):
+        """Test PayloadCache.get"""
+        cache = PayloadCache(3 * payload_size(np.zeros(10)))
+        loads = []
+        def loader(value):
+            loads.append(value)
+            return np.ones(10) * value
+        for value in [0, 1, 0, 2, 3, 0]:
+            assert np.all(cache.get('file{}'.format(value), 1.0,
+                                    lambda: loader(value)) == value)
+        assert loads == [0, 1, 2, 3]
+        stats = cache.stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == 4
+        assert stats['evictions'] == 1
+        assert stats['entries'] == 3
+        # A newer file isn't served from the cache
+        cache.get('file0', 2.0, lambda: loader(0))
+        assert loads == [0, 1, 2, 3, 0]
+        cache.resize(0)
+        assert cache.stats()['entries'] == 0
+        cache.get('file0', 2.0, lambda: loader(0))
+        assert loads == [0, 1, 2, 3, 0, 0]
+
+    def test_datum(self, random_datum_file):
+        """Test that Datum objects share payloads through the cache"""
+        payload_cache.resize(2**20)
+        try:
+            first = Datum.load(random_datum_file['filename'])
+            second = Datum.load(random_datum_file['filename'])
+            assert first.data is second.data
+            assert payload_cache.stats()['hits'] == 1
+        finally:
+            payload_cache.resize(0)
+            payload_cache.clear()
+
+    def test_store(self, result_store):
+        """Test that results in a ResultStore don't share payloads"""
+        payload_cache.resize(2**20)
+        try:
+            store = result_store['store']
+            datums = [store.load(params) for params in result_store['params']]
+            for datum in datums:
+                datum.timestamp = 1.0
+            for datum, params in zip(datums, result_store['params']):
+                assert datum.data == [params['a'], params['b']]
+        finally:
+            payload_cache.resize(0)
+            payload_cache.clear()
+
 class TestDatum(object):
 
     def test_init(self, random_datum, tmp_dir):
@@ -167,6 +240,79 @@ class TestDatum(object):
         assert t1 < shelf[b'timestamp'] < t2
         shelf.close()
 
+    def test_save_mmap(self, tmp_dir):
+        """Test saving array data to a memory-mapped .npy file"""
+        data = np.random.random((10, 4))
+        datum = Datum({'a': 1}, data, file_prefix=tmp_dir + '/mmap_', mmap=True)
+        try:
+            datum.save()
+            assert os.path.exists(datum.filename + '.npy')
+            new_datum = Datum.load(datum.filename)
+            assert isinstance(new_datum.data, np.memmap)
+            assert np.allclose(new_datum.data, data)
+            # Saving new data leaves existing memory maps untouched
+            Datum({'a': 1}, np.ones(3), file_prefix=tmp_dir + '/mmap_',
+                  mmap=True).save()
+            assert np.allclose(new_datum.data, data)
+            assert np.allclose(Datum.load(datum.filename).data, np.ones(3))
+        finally:
+            delete_shelve_files(datum.filename)
+
+        store = ResultStore(os.path.join(tmp_dir, 'mmap_store', 'results'))
+        try:
+            datum = Datum({'a': 1}, data, store=store, mmap=True)
+            datum.save()
+            old_data = store.read({'a': 1})
+            assert isinstance(old_data, np.memmap)
+            assert np.allclose(old_data, data)
+            store.append({'a': 1}, np.ones(3), mmap=True)
+            assert np.allclose(old_data, data)
+            assert np.allclose(store.read({'a': 1}), np.ones(3))
+        finally:
+            shutil.rmtree(os.path.join(tmp_dir, 'mmap_store'))
+
+    def test_save_serializer(self, tmp_dir):
+        """Test saving data with the registered serializers"""
+        payloads = [np.random.random((10, 4)), [1.0, [2.0, 3.0]], {'a': 1}]
+        for name, data in product(sorted(serializers.keys()), payloads):
+            datum = Datum({'a': 1}, data, file_prefix=tmp_dir + '/ser_',
+                          serializer=name)
+            try:
+                datum.save()
+                new_datum = Datum.load(datum.filename)
+                assert np.all(np.array(new_datum.data) == np.array(data))
+            finally:
+                delete_shelve_files(datum.filename)
+
+        store = ResultStore(os.path.join(tmp_dir, 'ser_store', 'results'))
+        try:
+            Datum({'a': 1}, payloads[0], store=store, serializer='numpy').save()
+            Datum({'a': 2}, payloads[1], store=store, serializer='zlib-6').save()
+            store = ResultStore(store.path)
+            assert np.allclose(store.read({'a': 1}), payloads[0])
+            assert store.read({'a': 2}) == payloads[1]
+        finally:
+            shutil.rmtree(os.path.join(tmp_dir, 'ser_store'))
+
+        with pytest.raises(ValueError):
+            get_serializer('some_non_existant_serializer')
+
+    def test_save_compression(self, tmp_dir):
+        """Test saving data to a compressed file"""
+        data = np.random.random((100, 4))
+        for payload in [data, data.tolist()]:
+            datum = Datum({'a': 1}, payload, file_prefix=tmp_dir + '/comp_',
+                          compression='zlib', compression_level=1)
+            try:
+                datum.save()
+                assert os.path.exists(datum.filename + '.z')
+                new_datum = Datum.load(datum.filename)
+                assert np.all(np.array(new_datum.data) == data)
+                new_datum = Datum.load(datum.filename)
+                assert np.all(np.array(new_datum.read(10, 20)) == data[10:20])
+            finally:
+                delete_shelve_files(datum.filename)
+
     def test_load(self, random_datum_file, tmp_dir):
         """Test the load function of the Datum class"""
         new_datum = Datum.load(random_datum_file["filename"])
@@ -183,6 +329,137 @@ class TestDatum(object):
         new_datum.delete()
         assert count_shelve_files(random_datum_file["filename"]) == 0
 
+class TestBackgroundSaver(object):
+
+    def test_save(self, tmp_dir):
+        """Test BackgroundSaver.save, flush and close"""
+        saved = []
+        saver = BackgroundSaver(2, batch_size=3, callback=saved.append)
+        prefix = os.path.join(tmp_dir, 'background', 'result_')
+        datums = [Datum({'a': a}, [a], prefix) for a in range(10)]
+        try:
+            for datum in datums:
+                saver.save(datum)
+            saver.flush()
+            assert saved == datums
+            for datum in datums:
+                assert Datum.load(datum.filename).data == datum.data
+            saver.close()
+            assert not saver._thread.is_alive()
+        finally:
+            shutil.rmtree(os.path.join(tmp_dir, 'background'))
+
+    def test_error(self, tmp_dir):
+        """Test that errors in the writer thread are raised"""
+        class BrokenStore(object):
+            def append(self, *args):
+                raise IOError("Broken")
+
+        saver = BackgroundSaver(2)
+        saver.save(Datum({'a': 1}, [1], store=BrokenStore()))
+        with pytest.raises(IOError):
+            saver.flush()
+        saver.close()
+
+class TestResultStore(object):
+
+    def test_init(self, result_store):
+        """Test ResultStore constructor"""
+        store = result_store['store']
+        assert store.data_file == result_store['path'] + ".dat"
+        assert store.index_file == result_store['path'] + ".idx"
+        assert os.path.exists(store.data_file)
+        assert os.path.exists(store.index_file)
+
+    def test_index(self, result_store):
+        """Test ResultStore.index"""
+        store = ResultStore(result_store['path'])
+        index = store.index()
+        assert len(index) == len(result_store['params'])
+        for params in result_store['params']:
+            assert ResultStore.key(params) in index
+
+    def test_read(self, result_store):
+        """Test ResultStore.append and ResultStore.read"""
+        store = ResultStore(result_store['path'])
+        for params in result_store['params']:
+            assert store.read(params) == [params['a'], params['b']]
+        store.append({'a': 0, 'b': 0}, 'foo')
+        assert len(store) == len(result_store['params'])
+        assert ResultStore(result_store['path']).read({'a': 0, 'b': 0}) == 'foo'
+
+    def test_load(self, result_store):
+        """Test ResultStore.load"""
+        store = result_store['store']
+        datum = store.load({'a': 2, 'b': 1})
+        assert not hasattr(datum, '_data')
+        assert datum.params == {'a': 2, 'b': 1}
+        assert datum.data == [2, 1]
+        assert store.load({'a': 5, 'b': 1}) is None
+
+    def test_remove(self, result_store):
+        """Test ResultStore.remove via Datum.delete"""
+        store = result_store['store']
+        store.load({'a': 2, 'b': 1}).delete()
+        assert store.load({'a': 2, 'b': 1}) is None
+        assert ResultStore(result_store['path']).load({'a': 2, 'b': 1}) is None
+
+    def test_dataset(self, result_store):
+        """Test DataSet backed by a ResultStore"""
+        config = Config()
+        config.from_dict({'RESULTS_DIR': 'results'})
+        dataset = DataSet(result_store['params'], config,
+                          store=result_store['store'])
+        assert len(dataset.all()) == len(result_store['params'])
+        assert dataset.filter(a=1).first().data == [1, 0]
+
+class TestManifest(object):
+
+    def test_add(self, random_dataset, tmp_dir):
+        """Test Manifest.add, Manifest.save and Manifest.load"""
+        manifest = Manifest(tmp_dir)
+        datums = random_dataset['dataset'].all()
+        for datum in datums:
+            manifest.add(datum)
+        try:
+            manifest.save()
+            assert os.path.exists(os.path.join(tmp_dir, '.manifest'))
+            manifest = Manifest(tmp_dir)
+            for datum in datums:
+                new_datum = manifest.load(datum.filename)
+                assert not hasattr(new_datum, '_data')
+                assert new_datum.params == datum.params
+                assert new_datum.timestamp == datum.timestamp
+                assert new_datum.data == datum.data
+            assert manifest.load(os.path.join(tmp_dir, 'blah.pkl')) is None
+        finally:
+            os.unlink(manifest.filename)
+
+    def test_rebuild(self, random_dataset, tmp_dir):
+        """Test Manifest.rebuild"""
+        manifest = Manifest(tmp_dir)
+        try:
+            manifest.rebuild()
+            filenames = [datum.filename
+                         for datum in random_dataset['dataset'].all()]
+            for filename in filenames:
+                assert manifest.load(filename) is not None
+        finally:
+            os.unlink(manifest.filename)
+
+    def test_dataset(self, random_dataset, tmp_dir):
+        """Test that a DataSet uses its manifest"""
+        manifest = Manifest(tmp_dir)
+        params = random_dataset['params'][0]
+        datum = Datum(params, None)
+        datum.filename = random_dataset['dataset'].first().filename
+        datum.timestamp = 1.0
+        manifest.add(datum)
+        dataset = DataSet(random_dataset['params'],
+                          random_dataset['dataset'].config, tmp_dir + '/',
+                          manifest=manifest)
+        assert dataset.first().timestamp == 1.0
+
 class TestDataSet(object):
 
     def test_init(self, random_dataset, tmp_dir):
@@ -223,6 +500,44 @@ class TestDataSet(object):
 
         assert counter == len(random_dataset['params'])
 
+        # Iterators are independent of each other
+        iter1 = iter(random_dataset['dataset'])
+        iter2 = iter(random_dataset['dataset'])
+        next(iter1)
+        pairs = list(zip(iter1, iter2))
+        assert len(pairs) == len(random_dataset['params']) - 1
+        for datum1, datum2 in pairs:
+            assert datum1.params != datum2.params
+
+    def test_iterate(self, random_dataset):
+        """Test DataSet.iterate with prefetching"""
+        datums = list(random_dataset['dataset'].iterate(prefetch=3,
+                                                        load_data=True))
+        assert [datum.params for datum in datums] == random_dataset['params']
+        for datum in datums:
+            assert hasattr(datum, '_data')
+
+
+class TestParameterIndex(object):
+
+    def test_evaluate(self, random_parameters):
+        """Test that ParameterIndex.evaluate matches Query.evaluate"""
+        index = ParameterIndex(random_parameters)
+        queries = [Query(), Query(a=1, b=10), Query(a=1, b__gte=20),
+                   Query(a__gt=3, b__lt=15), Query(b__lte=12),
+                   Query(a=1) | Query(b__gte=20),
+                   (Query(a=1) | Query(b__gte=20)) & Query(c='foo'),
+                   ~Query(a=1), Query(a__aprx=2.0000001), Query(a=100)]
+        for query in queries:
+            assert index.evaluate(query) == query.evaluate(random_parameters)
+        assert set(index._hash_indices.keys()) == set(['a', 'b', 'c'])
+        assert set(index._sorted_indices.keys()) == set(['a', 'b'])
+
+        query = Query()
+        query._set_filter(lambda x, y: x % y == 0, 'b', 7)
+        assert index.evaluate(query) == query.evaluate(random_parameters)
+        with pytest.raises(KeyError):
+            index.evaluate(Query(d=1))
 
 class TestQuery(object):
 
@@ -282,4 +597,38 @@ class TestQuery(object):
         results = q.evaluate(random_parameters)
         assert len(results) == 360
         for result in results:
-            assert not result['a'] == 1
\ No newline at end of file
+            assert not result['a'] == 1
+
+    def test_compile(self, random_parameters):
+        """Test that compiled queries agree with the recursive evaluation"""
+        queries = [Query(), Query(a=1, b=10), Query(a=1, b__gte=20),
+                   Query(a=1) | Query(b__gte=20) | Query(c='bar'),
+                   (Query(a=1) | Query(b__gte=20)) & Query(c='foo'),
+                   ~Query(a=1), ~(Query(a__lt=3) & ~Query(c='foo')),
+                   Query(a__aprx=2.0000001), Query(c__gt='cat')]
+        for query in queries:
+            compiled = query.compile()
+            assert isinstance(compiled, CompiledQuery)
+            expected = query._recurse(random_parameters)
+            assert list(compiled.mask(random_parameters)) == expected
+            assert [compiled(params) for params in random_parameters] == expected
+
+        # Sequence values are compared as single values
+        for values in [[(0, 0, 0), (0, 0, 1), (1, 0, 0)],
+                       [[0, 0, 0], [0, 0, 1], [1, 0, 0]]]:
+            parameters = [{'p': value} for value in values]
+            query = Query(p=values[1])
+            assert query._recurse(parameters) == [False, True, False]
+            assert list(query.compile().mask(parameters)) == [False, True,
+                                                              False]
+            assert query.evaluate(parameters) == [parameters[1]]
+            assert (ParameterIndex(parameters).evaluate(query)
+                    == [parameters[1]])
+            assert ((~query).evaluate(parameters)
+                    == [parameters[0], parameters[2]])
+
+        compiled = (Query(a=1) | Query(b__gte=20)).compile()
+        assert compiled.tree[0] == 'node'
+        assert len(compiled.tree[3]) == 2
+        compiled = Query(Query(Query(a=1))).compile()
+        assert compiled.tree[0] == 'filter'
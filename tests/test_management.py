@@ -56,4 +56,4 @@ class TestManager(object):
         assert manager.argv == sys.argv
         assert (set(manager.anflow_commands.keys())
                 == set(["startstudy", "shell", "describe", "run",
-                        "startproject"]))
+                        "startproject", "cache"]))
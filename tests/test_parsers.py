@@ -13,11 +13,15 @@ import shutil
 import pytest
 import numpy as np
 
-from anflow.data import FileWrapper
-from anflow.parsers import CombinedParser, GuidedParser, Parser
+from anflow.data import FileWrapper, payload_cache
+from anflow.parsers import (CombinedParser, GuidedParser, MissingFilesError,
+                            Parser, stat_files)
 
 
 
+def load_npy(filepath, b):
+    return np.load(filepath.format(b=b[0]))
+
 @pytest.fixture
 def data_to_parse(tmp_dir, request):
 
@@ -86,6 +90,26 @@ class TestParser(object):
         assert isinstance(combined_parser, CombinedParser)
         assert len(combined_parser) == 8
 
+def test_stat_files(data_to_parse):
+    """Test stat_files"""
+
+    rawdata_dir = data_to_parse['rawdata_dir']
+    filenames = []
+    for i in range(5):
+        filenames.append(os.path.join(rawdata_dir, "file{}.txt".format(i)))
+        with open(filenames[-1], 'w') as f:
+            f.write("{}".format(i))
+    for workers in [1, 4]:
+        timestamps = stat_files(filenames, workers)
+        assert timestamps == dict((filename, os.path.getmtime(filename))
+                                  for filename in filenames)
+
+    missing = [os.path.join(rawdata_dir, "missing.txt"),
+               os.path.join(rawdata_dir, "missing_dir", "missing.txt")]
+    with pytest.raises(MissingFilesError) as excinfo:
+        stat_files(filenames + missing)
+    assert excinfo.value.filenames == missing
+
 class TestGuidedParser(object):
 
     def test_init(self, data_to_parse):
@@ -111,6 +135,20 @@ class TestGuidedParser(object):
         assert parser.parsed_data[0].params == {'a': 1}
         assert parser.populated
 
+    def test_populate_missing(self, data_to_parse):
+        """Test that missing files are reported together"""
+
+        parser = GuidedParser(data_to_parse['template'],
+                              data_to_parse['load_func'],
+                              parameters=[{'a': 1}, {'a': 2}], b=[2, 3])
+        with pytest.raises(MissingFilesError) as excinfo:
+            parser.populate()
+        template = data_to_parse['template']
+        assert excinfo.value.filenames == [template.format(a=1, b=3),
+                                           template.format(a=2, b=2),
+                                           template.format(a=2, b=3)]
+        assert not parser.populated
+
     def test_iter(self, data_to_parse):
         """Test GuidedParser.__iter__ and GuidedParser.next"""
 
@@ -121,3 +159,80 @@ class TestGuidedParser(object):
             assert (datum.data == data_to_parse['data']).all()
 
         assert parser.populated
+
+    def test_payload_cache(self, data_to_parse):
+        """Test that parsers with the same template and different loaders
+        don't share payloads"""
+
+        def load_double(filepath, b):
+            return 2 * np.load(filepath.format(b=b[0]))
+
+        payload_cache.resize(2**20)
+        try:
+            first = GuidedParser(data_to_parse['template'],
+                                 data_to_parse['load_func'],
+                                 parameters=data_to_parse['params'], b=[2])
+            second = GuidedParser(data_to_parse['template'], load_double,
+                                  parameters=data_to_parse['params'], b=[2])
+            assert (list(first)[0].data == data_to_parse['data']).all()
+            assert (list(second)[0].data == 2 * data_to_parse['data']).all()
+            third = GuidedParser(data_to_parse['template'], load_double,
+                                 parameters=data_to_parse['params'], b=[2])
+            assert (list(third)[0].data == 2 * data_to_parse['data']).all()
+            assert payload_cache.stats()['hits'] == 1
+        finally:
+            payload_cache.resize(0)
+            payload_cache.clear()
+
+    def test_stream(self, data_to_parse):
+        """Test streaming iteration of GuidedParser"""
+
+        rawdata_dir = data_to_parse['rawdata_dir']
+        params = [{'a': a} for a in range(10)]
+        for a in range(10):
+            np.save(os.path.join(rawdata_dir, "data_a{}_b2.npy".format(a)),
+                    np.arange(a))
+        parser = GuidedParser(data_to_parse['template'],
+                              data_to_parse['load_func'], parameters=params,
+                              b=[2])
+        parser.streaming = True
+        parser.stream_batch_size = 3
+        assert len(parser) == 10
+        assert not parser.populated
+
+        stream = iter(parser)
+        first = next(stream)
+        assert first.params == {'a': 0}
+        assert not parser.populated
+        rest = list(stream)
+        assert [datum.params for datum in rest] == params[1:]
+        assert (rest[-1].data == np.arange(9)).all()
+        assert parser.populated
+        assert len(parser.parsed_data) == 10
+        assert parser.filter(a=1).streaming
+
+    def test_prefetch(self, data_to_parse):
+        """Test loading data ahead of use with thread and process pools"""
+
+        rawdata_dir = data_to_parse['rawdata_dir']
+        params = [{'a': a} for a in range(10)]
+        for a in range(10):
+            np.save(os.path.join(rawdata_dir, "data_a{}_b2.npy".format(a)),
+                    np.arange(a))
+        for executor, memory in [('thread', None), ('process', None),
+                                 ('thread', 0)]:
+            parser = GuidedParser(data_to_parse['template'], load_npy,
+                                  parameters=params, b=[2])
+            parser.prefetch = 3
+            parser.prefetch_executor = executor
+            parser.prefetch_memory = memory
+            parser.streaming = executor == 'process'
+            data = list(parser)
+            assert [datum.params for datum in data] == params
+            for a, datum in enumerate(data):
+                assert hasattr(datum, '_data')
+                assert (datum.data == np.arange(a)).all()
+
+            combined = parser + parser.filter(a=1)
+            combined.prefetch = 2
+            assert [datum.params for datum in combined] == params + [{'a': 1}]
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 import os
 import hashlib
+from multiprocessing import Pool
 try:
     import cPickle as pickle
 except ImportError:
@@ -15,9 +16,12 @@ import time
 import numpy as np
 import pytest
 
-from anflow.data import Datum
-from anflow.resamplers import (bin_data, cache_lookup, cache_dump, hashgen,
-                               Bootstrap, Jackknife, Resampler)
+from anflow.data import Datum, FileWrapper, payload_size
+from anflow.resamplers import (bin_data, bin_stream, blocking_analysis,
+                               cache_lookup, cache_dump, generate_bins,
+                               hashgen,
+                               Bootstrap, Jackknife, JackknifeSamples,
+                               Resampler, ResamplerCache, ResamplerResult)
 
 from .utils import delete_shelve_files
 
@@ -46,6 +50,16 @@ def resampler(tmp_dir, request):
     return {"resampler": resampler, "cache_path": cache_path, "do_resample": True,
             "binsize": 1, "average": True, 'error_name': 'error'}
 
+def square(data, error=None):
+    return data**2
+
+@Jackknife(resample=False, executor='process', workers=2, chunksize=2)
+def process_square(data):
+    return data**2
+
+def daemonic_process_square(datum):
+    return process_square(datum).data
+
 @pytest.fixture
 def cached_datum(tmp_dir, request):
     obj = ("foo", "bar", 1)
@@ -75,6 +89,62 @@ class TestFunctions(object):
         # Check that each bin value is correct
         for i, datum in enumerate(binned_data):
             assert np.allclose(datum, data[10*i:10*(i+1)].mean())
+        # Arrays aren't copied if there's no binning to do
+        assert bin_data(data, 1) is data
+        # Left over samples are discarded, and lists stay as lists
+        binned_data = bin_data(list(data[:25]), 10)
+        assert isinstance(binned_data, list)
+        assert np.allclose(binned_data, data[:20].reshape(2, 10).mean(axis=1))
+        data = np.random.random((100, 3))
+        assert np.allclose(bin_data(data, 5),
+                           data.reshape(20, 5, 3).mean(axis=1))
+
+    def test_bin_stream(self):
+        """Test bin_stream"""
+        data = np.random.random((100, 2))
+        chunks = [data[:7], data[7:8], data[8:50], data[50:]]
+        binned_data = list(bin_stream(iter(chunks), 4))
+        assert len(binned_data) == 4
+        assert np.allclose(np.concatenate(binned_data), bin_data(data, 4))
+
+    def test_blocking_analysis(self):
+        """Test blocking_analysis"""
+        np.random.seed(1)
+        uncorrelated = np.random.randn(2**12)
+        correlated = np.zeros(2**12)
+        for i in range(1, len(correlated)):
+            correlated[i] = 0.9 * correlated[i - 1] + uncorrelated[i]
+
+        analysis = blocking_analysis(uncorrelated)
+        assert analysis.binsizes == [2**i for i in range(9)]
+        assert analysis.errors.shape == (9,)
+        assert np.allclose(analysis.errors[0],
+                           uncorrelated.std(ddof=1) / 2**6)
+        assert analysis.binsize <= 2
+        assert abs(analysis.tau_int - 0.5) < 0.2
+
+        analysis = blocking_analysis(np.column_stack([uncorrelated,
+                                                      correlated]))
+        assert analysis.errors.shape == (9, 2)
+        assert analysis.binsize >= 16
+        assert analysis.tau_int[1] > 4
+        with pytest.raises(ValueError):
+            blocking_analysis(uncorrelated[:10])
+
+    def test_generate_bins(self):
+        """Test generate_bins"""
+        bins = generate_bins(100, 20)
+        assert bins.shape == (20, 100)
+        assert bins.dtype == np.uint8
+        assert bins.min() >= 0 and bins.max() < 100
+        assert generate_bins(1000, 5).dtype == np.uint16
+
+        bins = generate_bins(100, 20, seed=42)
+        assert generate_bins(100, 20, seed=42) is bins
+        assert not bins.flags.writeable
+        assert np.all(bins == np.random.RandomState(42).randint(100,
+                                                                size=(20, 100)))
+        assert not np.all(generate_bins(100, 20, seed=43) == bins)
 
     def test_hashgen(self):
         "Test hashgen"
@@ -128,6 +198,236 @@ class TestResampler(object):
         assert result.error == 0.5
         assert not result.bins
 
+    def test_executor(self, resampler):
+        """Test that samples can be processed using thread and process pools"""
+
+        with pytest.raises(ValueError):
+            Jackknife(executor='blah')
+
+        res = resampler['resampler']
+        res.executor = 'thread'
+        res.workers = 2
+        test_function = res(square)
+        result = test_function(Datum({'a': 1, 'b': 2}, [1.0, 2.0, 3.0]))
+        assert result.data == [1.0, 4.0, 9.0]
+
+        datum = Datum({'a': 1}, [1.0, 2.0, 3.0, 4.0])
+        datum.centre = 2.5
+        result = process_square(datum)
+        assert result.data == [1.0, 4.0, 9.0, 16.0]
+        assert result.centre == 6.25
+
+        # Workers of a process pool are daemonic, so can't start their own
+        # process pools
+        pool = Pool(1)
+        try:
+            assert (pool.apply(daemonic_process_square, (datum,))
+                    == [1.0, 4.0, 9.0, 16.0])
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_streamed(self, tmp_dir):
+        """Test resampling data that's streamed from a loader in chunks"""
+
+        data = np.random.random(100)
+        reads = []
+        def load(filename):
+            for i in range(0, 100, 30):
+                reads.append(i)
+                yield data[i:i + 30]
+        wrapper = FileWrapper('streamed', load, timestamp=time.time())
+        wrapper.params = {}
+        cache_path = os.path.join(tmp_dir, "cache")
+        expected = Jackknife(average=True, binsize=10)(lambda x: x)(
+            Datum({}, data))
+        ResamplerCache.clear()
+        try:
+            for i in range(2):
+                jackknife = Jackknife(average=True, binsize=10,
+                                      cache_path=cache_path)
+                result = jackknife(lambda x: x)(wrapper)
+                assert np.allclose(result.data, expected.data)
+                assert np.allclose(result.centre, expected.centre)
+                assert np.allclose(result.error, expected.error)
+            # The second run is a cache hit, so doesn't read the stream
+            assert ResamplerCache.counters['memory_hit'] == 1
+            assert reads == [0, 30, 60, 90]
+        finally:
+            ResamplerCache.clear()
+            shutil.rmtree(cache_path, ignore_errors=True)
+
+    def test_auto_binsize(self):
+        """Test choosing the binsize using a blocking analysis"""
+
+        data = np.random.random(256)
+        jackknife = Jackknife(average=True, binsize='auto')
+        result = jackknife(lambda x: x)(Datum({}, data))
+        binsize = jackknife.blocking.binsize
+        assert jackknife.blocking.binsizes[0] == 1
+        assert len(result.data) == 256 // binsize
+
+        # Too few samples for the analysis, so the data isn't binned
+        result = jackknife(lambda x: x)(Datum({}, data[:10]))
+        assert jackknife.blocking is None
+        expected = Jackknife(average=True)(lambda x: x)(Datum({}, data[:10]))
+        assert np.allclose(result.data, expected.data)
+
+    def test_vectorized(self):
+        """Test applying a function to the whole stack of samples at once"""
+
+        data = np.random.random((20, 3))
+        calls = []
+        def measure(samples):
+            calls.append(samples.shape)
+            return 2 * samples
+        for resampler, vectorized_resampler in [
+                (Jackknife(average=True),
+                 Jackknife(average=True, vectorized=True)),
+                (Bootstrap(average=True, num_bootstraps=10, seed=1),
+                 Bootstrap(average=True, num_bootstraps=10, seed=1,
+                           vectorized=True))]:
+            expected = resampler(lambda x: 2 * x)(Datum({}, data))
+            del calls[:]
+            result = vectorized_resampler(measure)(Datum({}, data))
+            assert calls == [(len(expected.data), 3), (1, 3)]
+            assert isinstance(result.data, np.ndarray)
+            assert np.allclose(result.data, expected.data)
+            assert np.allclose(result.centre, expected.centre)
+            assert np.allclose(result.error, expected.error)
+
+    def test_vectorized_reducing(self):
+        """Test vectorized measurements that change the shape of the
+        samples, both when resampling and on chained results"""
+
+        data = np.random.random((20, 3))
+        for make_resampler in [
+                Jackknife,
+                lambda **kwargs: Bootstrap(num_bootstraps=10, seed=1,
+                                           **kwargs)]:
+            first = make_resampler(average=True)(lambda x: x)(Datum({}, data))
+            for resample, input_data in [(True, data), (False, first)]:
+                expected = make_resampler(average=True, resample=resample)(
+                    lambda x: x.sum(axis=-1))(Datum({}, input_data))
+                result = make_resampler(average=True, resample=resample,
+                                        vectorized=True)(
+                    lambda samples: samples.sum(axis=-1))(
+                        Datum({}, input_data))
+                assert np.allclose(result.data, expected.data)
+                assert np.allclose(result.centre, expected.centre)
+                assert np.allclose(result.error, expected.error)
+
+    def test_chained(self):
+        """Test resampling the output of another resampled model"""
+
+        data = np.random.random((20, 3))
+        first = Jackknife(average=True)(lambda x: x)(Datum({}, data))
+        second = Jackknife(resample=False, vectorized=True,
+                           error_name='error')
+        errors = []
+        def measure(samples, error):
+            errors.append(error)
+            return samples.sum(axis=-1)
+        result = second(measure)(Datum({}, first))
+        assert np.allclose(errors[0], first.error)
+        assert np.allclose(result.data, np.sum(first.data, axis=-1))
+        assert np.allclose(result.centre, first.centre.sum())
+        assert np.allclose(result.error,
+                           np.sqrt(first.covariance().sum()))
+
+    def test_compression(self, resampler):
+        """Test that resampled data can be compressed in the cache"""
+
+        res = resampler['resampler']
+        res.compression = 'zlib'
+        test_function = res(square)
+        datum = Datum({'a': 1, 'b': 2}, [1.0, 2.0, 3.0])
+        datum.timestamp = time.time()
+        result = test_function(datum)
+        assert result.data == [1.0, 4.0, 9.0]
+        filenames = [f for f in os.listdir(resampler['cache_path'])
+                     if f.endswith('.z')]
+        assert len(filenames) == 1
+        datum = Datum.load(os.path.join(resampler['cache_path'],
+                                        filenames[0][:-2]))
+        assert datum.data['samples'] == [1.0, 2.0, 3.0]
+
+    def test_cache(self, tmp_dir):
+        """Test that resampled data is cached in memory and on disk"""
+
+        cache_path = os.path.join(tmp_dir, "resampler_cache")
+        ResamplerCache.clear()
+        datum = Datum({'a': 1}, np.random.random(10))
+        datum.timestamp = time.time()
+        try:
+            bootstrap = Bootstrap(average=True, num_bootstraps=5,
+                                  cache_path=cache_path)
+            bootstrap_function = bootstrap(lambda data: data)
+            result = bootstrap_function(datum)
+            assert ResamplerCache.counters['miss'] == 1
+            # The generated bins are cached with the samples
+            assert np.all(bootstrap_function(datum).bins == result.bins)
+            assert ResamplerCache.counters['miss'] == 1
+            assert ResamplerCache.counters['memory_hit'] == 1
+            assert np.allclose(bootstrap_function(datum).data, result.data)
+            assert ResamplerCache.counters['memory_hit'] == 2
+            assert len(set(f.split('.')[0]
+                           for f in os.listdir(cache_path))) == 1
+
+            # A new resampler with the same parameters finds the data on
+            # disk, along with the bins used to generate it
+            ResamplerCache.clear()
+            bootstrap = Bootstrap(average=True, num_bootstraps=5,
+                                  cache_path=cache_path)
+            new_result = bootstrap(lambda data: data)(datum)
+            assert ResamplerCache.counters['disk_hit'] == 1
+            assert np.allclose(new_result.data, result.data)
+            assert np.all(bootstrap.bins == result.bins)
+
+            # Different bins mean different samples
+            bins = [[0] * 10 for i in range(5)]
+            bootstrap = Bootstrap(average=True, bins=bins,
+                                  cache_path=cache_path)
+            new_result = bootstrap(lambda data: data)(datum)
+            assert ResamplerCache.counters['miss'] == 1
+            assert np.allclose(new_result.data, datum.data[0])
+        finally:
+            ResamplerCache.clear()
+            shutil.rmtree(cache_path, ignore_errors=True)
+
+    def test_cache_memory(self):
+        """Test that the in-memory cache is bounded in size and only used
+        when caching is enabled"""
+
+        import __main__
+        old_main_file = __main__.__file__
+        # Make sure there's no project configuration supplying a cache path
+        __main__.__file__ = 'not_a_project.py'
+        max_size = ResamplerCache.max_size
+        ResamplerCache.clear()
+        datum = Datum({'a': 1}, np.random.random((100, 10)))
+        datum.timestamp = time.time()
+        try:
+            Jackknife(average=True)(lambda data: data)(datum)
+            assert len(ResamplerCache._memory) == 0
+            assert sum(ResamplerCache.counters.values()) == 0
+
+            size = payload_size(np.zeros(1000))
+            ResamplerCache.resize(2 * size)
+            cache = ResamplerCache()
+            for key in ['a', 'b', 'c']:
+                cache.store((key,), {}, np.zeros(1000))
+            assert list(ResamplerCache._memory.keys()) == [('b',), ('c',)]
+            assert ResamplerCache._size == 2 * size
+            cache.store(('d',), {}, np.zeros(3000))
+            assert ('d',) not in ResamplerCache._memory
+            ResamplerCache.resize(0)
+            assert len(ResamplerCache._memory) == 0
+        finally:
+            __main__.__file__ = old_main_file
+            ResamplerCache.resize(max_size)
+            ResamplerCache.clear()
+
 class TestJackknife(object):
 
     def test_central_value(self):
@@ -160,6 +460,27 @@ class TestJackknife(object):
         jack = Jackknife(average=True)
         assert jack._resample(data) == [2.5, 2.0, 1.5]
 
+    def test_resample_array(self):
+        """Test Jackknife._resample with array data"""
+        data = np.random.random((5, 3))
+        jack = Jackknife()
+        samples = jack._resample(data)
+        assert isinstance(samples, JackknifeSamples)
+        assert len(samples) == 5
+        for i, sample in enumerate(samples):
+            assert np.allclose(sample, np.delete(data, i, axis=0))
+        jack = Jackknife(average=True)
+        samples = jack._resample(data)
+        for i, sample in enumerate(samples):
+            assert np.allclose(sample, np.delete(data, i, axis=0).mean(axis=0))
+
+    def test_error_array(self):
+        """Test Jackknife._error with array data"""
+        data = np.random.random((10, 4))
+        centre = data.mean(axis=0)
+        assert np.allclose(Jackknife._error(list(data), centre),
+                           np.sqrt(9) * np.std(data, axis=0))
+
 class TestBootstrap(object):
 
     def test_init(self):
@@ -196,3 +517,55 @@ class TestBootstrap(object):
                                         [1.0, 3.0, 3.0]]
         boot = Bootstrap(average=True, bins=bins)
         assert boot._resample(data) == [4.0 / 3.0, 2.0, 7.0 / 3.0]
+
+    def test_seed(self):
+        """Test that bootstraps with the same seed use the same bins"""
+        data = np.random.random((50, 2))
+        first = Bootstrap(average=True, num_bootstraps=10, seed=1)
+        second = Bootstrap(average=True, num_bootstraps=10, seed=1)
+        assert np.allclose(first._resample(data), second._resample(data))
+        assert first.bins is second.bins
+        # The bins are generated for the length of each dataset
+        assert first._resample(data[:20]).shape == (10, 2)
+        assert first.bins.shape == (10, 20)
+
+    def test_resample_array(self):
+        """Test Bootstrap._resample with array data"""
+        bins = [[0, 1, 0], [1, 2, 0], [0, 2, 2]]
+        data = np.array([[1.0, 10.0], [2.0, 20.0], [3.0, 30.0]])
+        boot = Bootstrap(bins=bins)
+        assert np.allclose(boot._resample(data), data[np.array(bins)])
+        boot = Bootstrap(average=True, bins=bins)
+        assert np.allclose(boot._resample(data),
+                           data[np.array(bins)].mean(axis=1))
+
+class TestResamplerResult(object):
+
+    def test_covariance(self):
+        """Test ResamplerResult.covariance and ResamplerResult.correlation"""
+        data = np.random.random((20, 3))
+        for resampler in [Jackknife(average=True),
+                          Bootstrap(average=True, num_bootstraps=30)]:
+            result = resampler(lambda x: x)(Datum({}, data))
+            assert result.kind == resampler.kind
+            covariance = result.covariance()
+            assert covariance.shape == (3, 3)
+            assert np.allclose(np.diag(covariance), result.error**2)
+            assert np.allclose(covariance, covariance.T)
+            assert result.covariance() is covariance
+
+            shrunk = result.covariance(0.5)
+            assert np.allclose(np.diag(shrunk), np.diag(covariance))
+            assert np.allclose(shrunk - np.diag(np.diag(shrunk)),
+                               (covariance - np.diag(np.diag(covariance)))
+                               / 2)
+
+            correlation = result.correlation()
+            assert np.allclose(np.diag(correlation), 1)
+            assert np.all(np.abs(correlation) <= 1 + 1e-12)
+
+        with pytest.raises(ValueError):
+            result.covariance(2)
+        with pytest.raises(ValueError):
+            ResamplerResult(list(data), data.mean(axis=0), None,
+                            None).covariance()
@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+from anflow import Simulation
+from anflow.data import Datum
+from anflow.scheduler import Scheduler
+
+
+
+@pytest.fixture
+def chained_sim(tmp_dir, request):
+
+    settings = {'RESULTS_DIR': os.path.join(tmp_dir, "results"),
+                'REPORTS_DIR': os.path.join(tmp_dir, "reports")}
+    sim = Simulation("testsim", root_path=tmp_dir)
+    sim.config.from_dict(settings)
+
+    calls = []
+    lock = threading.Lock()
+
+    def record(name):
+        def func(data):
+            with lock:
+                calls.append(name)
+            return data
+        return func
+
+    sim.register_parser('input', [Datum({'a': 1}, 1.0)])
+    sim.register_model('model1', record('model1'), 'input')
+    sim.register_model('model2', record('model2'), 'model1')
+    sim.register_model('model3', record('model3'), 'input')
+    sim.register_view('view', record('view'), ('model2', 'model3'))
+
+    def fin():
+        shutil.rmtree(settings['RESULTS_DIR'], ignore_errors=True)
+        shutil.rmtree(settings['REPORTS_DIR'], ignore_errors=True)
+    request.addfinalizer(fin)
+
+    return {'simulation': sim, 'calls': calls}
+
+class TestScheduler(object):
+
+    def test_build_graph(self, chained_sim):
+        """Test Scheduler.build_graph"""
+        scheduler = Scheduler(chained_sim['simulation'])
+        graph = scheduler.build_graph()
+        assert graph == {('parser', 'input'): set(),
+                         ('model', 'model1'): set([('parser', 'input')]),
+                         ('model', 'model2'): set([('model', 'model1')]),
+                         ('model', 'model3'): set([('parser', 'input')]),
+                         ('view', 'view'): set([('model', 'model2'),
+                                                ('model', 'model3')])}
+
+        sim = chained_sim['simulation']
+        sim.register_model('model1', lambda data: data, 'model2')
+        with pytest.raises(ValueError):
+            scheduler.build_graph()
+        sim.register_model('model1', lambda data: data, 'blah')
+        with pytest.raises(KeyError):
+            scheduler.build_graph()
+
+    def test_run(self, chained_sim):
+        """Test Scheduler.run"""
+        scheduler = Scheduler(chained_sim['simulation'], workers=3)
+        scheduler.run()
+        calls = chained_sim['calls']
+        assert sorted(calls) == ['model1', 'model2', 'model3', 'view']
+        assert calls.index('model1') < calls.index('model2')
+        assert calls[-1] == 'view'
+        assert 'model3' in chained_sim['simulation'].results
+
+    def test_run_view_alone(self, chained_sim):
+        """Test that nothing else runs while a view is in its reports
+        directory"""
+
+        sim = chained_sim['simulation']
+        cwd = os.getcwd()
+        model_cwds = []
+
+        def view(data):
+            time.sleep(0.1)
+
+        def model(data):
+            time.sleep(0.05)
+            model_cwds.append(os.getcwd())
+            return data
+
+        sim.register_view('view', view, ('model1',))
+        sim.register_model('model2', model, 'model1')
+        sim.register_model('model3', model, 'model1')
+        Scheduler(sim, workers=3).run()
+        assert model_cwds == [cwd, cwd]
+        assert os.getcwd() == cwd
+
+    def test_model_workers(self, chained_sim):
+        """Test that models are only run with several processes when the
+        branches run one at a time"""
+
+        sim = chained_sim['simulation']
+        assert Scheduler(sim, workers=1, model_workers=4).model_workers == 4
+        assert Scheduler(sim, workers=3, model_workers=4).model_workers == 1
+        assert Scheduler(sim, workers=3).model_workers is None
@@ -3,19 +3,33 @@ from __future__ import unicode_literals
 
 import importlib
 import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import shelve
 import shutil
 import sys
 import time
 
+import numpy as np
 import pytest
 
 from anflow import Simulation
-from anflow.data import DataSet, Datum, Query
+from anflow.data import DataSet, Datum, FileWrapper, Query
+from anflow.simulation import detach_datum
 
 from .utils import delete_shelve_files, count_shelve_files
 
 
+class CountedPickle(object):
+    """Counts the number of times objects of this class are pickled"""
+    pickles = 0
+
+    def __getstate__(self):
+        CountedPickle.pickles += 1
+        return {}
+
 @pytest.fixture
 def sim(tmp_dir, request):
 
@@ -41,6 +55,7 @@ def sim(tmp_dir, request):
         f.write('def func1(data): return data\n')
         f.write('def func2(data): return data\n')
         f.write('def func3(data): pass\n')
+        f.write('def func4(data): return sum(sum(chunk) for chunk in data)\n')
     sys.path.insert(0, tmp_dir)
     module = importlib.import_module('functions')
     
@@ -112,6 +127,13 @@ class TestSimulation(object):
         assert simulation.models['some_func'].func == some_func
         assert simulation.models['some_func'].input_tag == "input_tag"
         assert simulation.models['some_func'].path_template is None
+        assert simulation.models['some_func'].serializer is None
+        simulation.register_model("other_func", some_func, "input_tag",
+                                  serializer='zlib-1')
+        assert simulation.models['other_func'].serializer == 'zlib-1'
+        with pytest.raises(ValueError):
+            simulation.register_model("bad_func", some_func, "input_tag",
+                                      serializer='foo')
 
     def test_register_view(self, run_sim):
         """Test Simulation.register_view"""
@@ -140,6 +162,8 @@ class TestSimulation(object):
             fname = 'a{a}_b{b}.pkl'.format(**params)
             assert count_shelve_files(os.path.join(tmp_dir, "results",
                                                    'func1', fname)) > 0
+        assert os.path.exists(os.path.join(tmp_dir, "results", "func1",
+                                           ".manifest"))
 
         simulation.run_model('func2', query=Query(a=1))
         for params in sim['parameters']:
@@ -151,6 +175,182 @@ class TestSimulation(object):
                 assert count_shelve_files(os.path.join(tmp_dir, "results",
                                                        'func2', fname)) == 0
 
+    def test_run_model_parallel(self, sim, tmp_dir):
+        """Test Simulation.run_model using a process pool"""
+
+        simulation = sim['simulation']
+        simulation.register_parser('input', sim['input_data'])
+        simulation.register_model('func2', sim['module'].func2, 'input')
+
+        simulation.run_model('func2', [{'c': 1}, {'c': 2}], query=Query(b=1),
+                             workers=2)
+        expected_params = [dict(params, c=c) for params in sim['parameters']
+                           for c in [1, 2] if params['b'] == 1]
+        assert simulation.results['func2']._params == expected_params
+        for datum in simulation.results['func2']:
+            assert datum.data == 1.0
+
+        def loader(filename):
+            raise IOError("Can't read {}".format(filename))
+        wrapper = FileWrapper('missing', loader, timestamp=time.time())
+        wrapper.params = {'a': 1}
+        simulation.register_parser('broken', [wrapper])
+        simulation.register_model('func1', sim['module'].func1, 'broken')
+        with pytest.raises(IOError):
+            simulation.run_model('func1', workers=2)
+
+    def test_run_model_incremental(self, sim, tmp_dir):
+        """Test that Simulation.run_model skips up to date results"""
+
+        simulation = sim['simulation']
+        calls = []
+        def func1(data):
+            calls.append(data)
+            return data
+        simulation.register_parser('input', sim['input_data'])
+        simulation.register_model('func1', func1, 'input')
+
+        simulation.run_model('func1')
+        assert len(calls) == len(sim['input_data'])
+        simulation.run_model('func1')
+        assert len(calls) == len(sim['input_data'])
+        assert (simulation.results['func1']._params
+                == [datum.params for datum in sim['input_data']])
+
+        time.sleep(0.01)
+        sim['input_data'][0].save()
+        simulation.run_model('func1')
+        assert len(calls) == len(sim['input_data']) + 1
+        simulation.run_model('func1', force=True)
+        assert len(calls) == 2 * len(sim['input_data']) + 1
+
+    def test_run_model_deleted(self, sim, tmp_dir):
+        """Test that results deleted since the manifest was written are
+        recomputed"""
+
+        simulation = sim['simulation']
+        calls = []
+        def func1(data):
+            calls.append(data)
+            return data
+        simulation.register_parser('input', sim['input_data'])
+        simulation.register_model('func1', func1, 'input')
+
+        simulation.run_model('func1')
+        filename = os.path.join(tmp_dir, "results", "func1", "a0_b0.pkl")
+        delete_shelve_files(filename)
+        # The manifest isn't checked against the files when iterating
+        assert len(simulation.results['func1'].all()) == len(calls)
+        with pytest.raises(IOError):
+            simulation.results['func1'].filter(a=0, b=0).first().data
+        simulation.run_model('func1')
+        assert len(calls) == len(sim['input_data']) + 1
+        for datum in simulation.results['func1']:
+            assert datum.data == 1.0
+
+    def test_run_model_cache(self, sim, tmp_dir):
+        """Test that Simulation.run_model uses the result cache"""
+
+        simulation = sim['simulation']
+        cache_path = os.path.join(tmp_dir, "result_cache")
+        simulation.config.RESULT_CACHE_PATH = cache_path
+        calls = []
+        def func1(data):
+            calls.append(data)
+            return data
+        simulation.register_parser('input', sim['input_data'])
+        simulation.register_model('func1', func1, 'input')
+
+        try:
+            simulation.run_model('func1', force=True)
+            assert len(calls) == len(sim['input_data'])
+            shutil.rmtree(simulation.config.RESULTS_DIR)
+            simulation.run_model('func1', force=True)
+            assert len(calls) == len(sim['input_data'])
+            for datum in simulation.results['func1']:
+                assert datum.data == 1.0
+
+            # The input data is only hashed once for all the parameters
+            def func2(data, c):
+                return 1.0
+            simulation.register_parser('counted',
+                                       [Datum({'a': 1}, CountedPickle())])
+            simulation.register_model('func2', func2, 'counted')
+            CountedPickle.pickles = 0
+            simulation.run_model('func2', [{'c': c} for c in range(3)],
+                                 force=True)
+            assert CountedPickle.pickles == 1
+        finally:
+            shutil.rmtree(cache_path, ignore_errors=True)
+
+    def test_run_model_streamed(self, sim, tmp_dir):
+        """Test running a model on data streamed in chunks, with the result
+        cache and with a process pool"""
+
+        simulation = sim['simulation']
+        cache_path = os.path.join(tmp_dir, "result_cache")
+        simulation.config.RESULT_CACHE_PATH = cache_path
+        wrapper = FileWrapper('streamed', lambda filename: iter([[1.0, 2.0],
+                                                                 [3.0]]),
+                              timestamp=time.time())
+        wrapper.params = {'a': 1}
+        simulation.register_parser('input', [wrapper])
+        simulation.register_model('func4', sim['module'].func4, 'input')
+
+        try:
+            for workers in [None, 2]:
+                simulation.run_model('func4', force=True, workers=workers)
+                assert simulation.results['func4'].first().data == 6.0
+            assert os.listdir(cache_path)
+        finally:
+            shutil.rmtree(cache_path, ignore_errors=True)
+
+        simulation.config.RESULT_CACHE_PATH = None
+        simulation.run_model('func4', force=True, workers=2)
+        assert simulation.results['func4'].first().data == 6.0
+
+    def test_detach_datum(self):
+        """Test that streamed data is read before it's sent to a process"""
+
+        wrapper = FileWrapper('streamed',
+                              lambda filename: (np.arange(i, i + 2)
+                                                for i in range(0, 6, 2)),
+                              timestamp=1.0)
+        wrapper.params = {'a': 1}
+        detached = detach_datum(wrapper)
+        assert np.all(detached.data == np.arange(6))
+        assert detached.params == {'a': 1}
+        assert detached.timestamp == 1.0
+        pickle.dumps(detached, 2)
+
+    def test_run_model_background(self, sim, tmp_dir):
+        """Test Simulation.run_model saving results in the background"""
+
+        simulation = sim['simulation']
+        simulation.config.SAVE_QUEUE_SIZE = 2
+        simulation.register_parser('input', sim['input_data'])
+        simulation.register_model('func2', sim['module'].func2, 'input')
+
+        simulation.run_model('func2')
+        assert len(simulation.results['func2'].all()) == len(sim['parameters'])
+        for datum in simulation.results['func2']:
+            assert datum.data == 1.0
+
+    def test_run_model_store(self, sim, tmp_dir):
+        """Test Simulation.run_model with a consolidated results store"""
+
+        simulation = sim['simulation']
+        simulation.config.RESULTS_STORE = 'consolidated'
+        simulation.register_parser('input', sim['input_data'])
+        simulation.register_model('func2', sim['module'].func2, 'input')
+
+        simulation.run_model('func2')
+        results_dir = os.path.join(tmp_dir, "results", "func2")
+        assert sorted(os.listdir(results_dir)) == ['results.dat', 'results.idx']
+        assert len(simulation.results['func2'].all()) == len(sim['parameters'])
+        for datum in simulation.results['func2']:
+            assert datum.data == 1.0
+
     def test_run_view(self, run_sim, tmp_dir):
         """Test Simulation.run_model"""
 
@@ -3,15 +3,20 @@ from __future__ import unicode_literals
 
 import importlib
 import os
+import pickle
 import sys
 
 import pytest
 
 from anflow.utils import (extract_from_format, get_dependency_files,
-                          get_root_path)
+                          get_root_path, prefetch_map, PicklableFunction)
 
 
 
+def add(a, b, c=0):
+    return a + b + c
+
+
 @pytest.fixture
 def dummy_module(tmp_dir, request):
 
@@ -64,3 +69,29 @@ class TestFunctions(object):
         assert result.group('foo') == 'spam'
         assert result.group('bar') == 'eggs'
         assert result.group('derp') == 'ham'
+
+    def test_picklable_function(self):
+        """Test PicklableFunction"""
+        func = PicklableFunction(add, 2, c=3)
+        assert func(1) == 6
+        unpickled = pickle.loads(pickle.dumps(func, 2))
+        assert unpickled.func is add
+        assert unpickled(1) == 6
+
+    def test_prefetch_map(self):
+        """Test prefetch_map"""
+        items = list(range(20))
+        expected = [x**2 for x in items]
+        assert list(prefetch_map(lambda x: x**2, items, 0)) == expected
+        assert list(prefetch_map(lambda x: x**2, items, 4)) == expected
+        results = prefetch_map(lambda x: x**2, items, 4)
+        assert next(results) == 0
+        results.close()
+        assert (list(prefetch_map(PicklableFunction(add, 0), items, 4,
+                                  executor='process'))
+                == items)
+
+        # Results are still returned in order when there's a memory limit
+        results = prefetch_map(lambda x: x, items, 4, max_bytes=2,
+                               sizeof=lambda x: 1)
+        assert list(results) == items
@@ -89,6 +89,7 @@ class TestFunctions(object):
         assert sim.models['model_some_func'].func == mod.some_func
         assert sim.models['model_some_func'].input_tag == 'parsed_data'
         assert sim.models['model_some_func'].path_template is None
+        assert sim.models['model_some_func'].serializer is None
 
     def test_view_from_elem(self, testtree, sim):
         """Test view_from_elem"""